@@ -1,12 +1,16 @@
-import csv
 import numpy as np
-import scipy
-import matplotlib.pyplot as plt
-import scipy
 import json
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from scipy import signal
 
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the json module
+    orjson = None
+
 
 # Constants:
 moist_air_density = 1.199  # kg/m^3
@@ -23,53 +27,70 @@ A1 = np.pi*((d1/2)**2)  # m^2
 # Cross-sectional area at the constriction:
 A2 = np.pi*((d2/2)**2)  # m^2
 
+# ADC-to-Pa conversion (ADC -> cm-H2O -> Pa), offset by 1638 ADC counts:
+adc_to_Pa = (25.4 / (14745 - 1638)) * 98.0665  # Pa per ADC count
+
+# Denominator of the Venturi equation:
+venturi_denominator = moist_air_density * ((A1 / A2) ** 2 - 1)
+
+# Scale from an ADC pressure difference to the term under the square
+# root of the Venturi equation, 2 * (p1 - p2) / denominator:
+venturi_scale = 2 * adc_to_Pa / venturi_denominator
+
+# Number of samples processed at a time by flow_vs_time (about 1.8 MB of
+# 7-channel float64 data, small enough to stay in cache):
+block_size = 32768
+
 
-def data_acquisition(filename, logger):
+def data_acquisition(filename, logger, dtype=np.float64):
     """Reads patient data from a txt as a CSV and returns
     it as a NumPy array.
 
     This function opens a specified CSV file containing
-    patient data, skips the header line, and processes
-    each subsequent line to convert each value from string
-    to float. It constructs a list of lists where each inner
-    list represents a line from the CSV file with valid float
-    values. Lines with any values that cannot be converted to
-    float or contain NaN values are logged as errors and
-    skipped. The resulting list of lists is then converted to
-    a 2D NumPy array and returned.
+    patient data, skips the header line, and parses the
+    remaining lines into a 2D float array in a single call to
+    np.loadtxt. If the file contains values that cannot be
+    converted to float, it is re-parsed with np.genfromtxt,
+    which stores those values as NaN. Lines with any values
+    that cannot be converted to float or contain NaN values
+    are logged as errors and skipped.
+
+    The ADC channels are integer counts that are stored exactly in
+    single precision, so dtype=np.float32 can be passed to halve the
+    size of the data array and of the flow rate and filtered flow
+    rate arrays computed from it. Time stamps are then rounded to
+    single precision as well.
 
     Args:
         filename (str): The path to the CSV file containing
         patient data.
 
+        dtype (data-type): The float type of the returned array
+        (default: np.float64).
+
     Returns:
         numpy.ndarray: A 2D NumPy array where each row represents
         a line from the CSV file, excluding the header and any
         lines with invalid inputs.
     """
+    try:
+        data = np.loadtxt(filename, delimiter=',', skiprows=1, ndmin=2,
+                          dtype=dtype)
+    except ValueError:
+        # Non-numeric entries are read in as NaN:
+        data = np.genfromtxt(filename, delimiter=',', skip_header=1,
+                             ndmin=2, dtype=dtype)
 
-    with open(filename, 'r') as patient_data:
-        result = []
-        csv_file = csv.reader(patient_data)
-        next(csv_file)  # Skip the first line (header)
-
-        for line in csv_file:
-            try:
-                time_point_lst = [float(x) for x in line]
-                time_point_arr = np.array(time_point_lst)
-
-                # Checking for NaN values
-                if np.isnan(time_point_arr).any():
-                    logger.error("Invalid Input")
-                    continue
+    # Checking for NaN values
+    invalid_rows = np.isnan(data).any(axis=1)
+    invalid_count = np.count_nonzero(invalid_rows)
+    if invalid_count == 0:
+        return data  # Nothing to drop, avoid copying the array
 
-                result.append(time_point_lst)
+    for _ in range(invalid_count):
+        logger.error("Invalid Input")
 
-            except ValueError:
-                logger.error("Invalid Input")
-                continue
-
-    return np.array(result)
+    return data[~invalid_rows]
 
 
 def flow_vs_time(data):
@@ -112,45 +133,77 @@ def flow_vs_time(data):
     cross-sectional area ratio between the tube's main section and the
     constriction. If the expiration pressure is greater than the
     inspiration pressure, the flow rate is considered negative,
-    indicating expiration flow.
+    indicating expiration flow. Samples where the constriction
+    pressure exceeds the upstream pressure are given a flow rate of
+    zero.
 
     Note:
         The conversion factors used for ADC to cm-H2O and cm-H2O to
         Pa are specific to the sensor and conditions under which the
         data was collected.
     """
-    result = []
-
-    for row in data:
-        time = row[0]
-        p1_ins_ADC = row[2]
-        p1_exp_ADC = row[3]
-        p2_ADC = row[1]
+    # Output array is allocated once, in the precision of the input
+    # data, and filled column by column. It is stored column-major, so
+    # that the time and flow rate columns that every caller slices out
+    # are each contiguous in memory:
+    result = np.empty((data.shape[0], 2), dtype=data.dtype, order='F')
+
+    # Long recordings are processed in blocks of samples so that the
+    # channels being worked on stay cache-resident between passes:
+    for start in range(0, data.shape[0], block_size):
+        block = data[start:start + block_size]
+        result[start:start + block_size, 0] = block[:, 0]
+        flow_rate = result[start:start + block_size, 1]
+
+        p2_ADC = block[:, 1]
+        p1_ins_ADC = block[:, 2]
+        p1_exp_ADC = block[:, 3]
+
+        # The adc-to-pressure conversion is linear with a positive slope,
+        # so the upstream pressure is picked and the difference to the
+        # pressure at the constriction taken on the raw ADC values (the
+        # 1638 offset cancels out). The conversion to Pa is folded into
+        # venturi_scale:
+        np.maximum(p1_ins_ADC, p1_exp_ADC, out=flow_rate)
+        flow_rate -= p2_ADC
+
+        # Sensor noise can put the constriction pressure above the
+        # upstream pressure; clamp those samples to zero flow instead of
+        # taking the square root of a negative number (which gives NaN):
+        np.maximum(flow_rate, 0, out=flow_rate)
+
+        # flow_rate calculation, done in place on the output column:
+        flow_rate *= venturi_scale
+        np.sqrt(flow_rate, out=flow_rate)
+        flow_rate *= A1
+        np.negative(flow_rate, out=flow_rate,
+                    where=p1_exp_ADC > p1_ins_ADC)
+
+    return result
+
+
+@lru_cache(maxsize=32)
+def design_lowpass_filter(cutoff_freq, sampling_rate):
+    """Designs the 2nd-order Butterworth lowpass filter used to
+    smooth flow rate data, in transfer function (b, a) form. A
+    single 2nd-order section gains nothing from the SOS cascade,
+    so the plain numerator/denominator form is used with lfilter.
+
+    The filter coefficients only depend on the cutoff frequency
+    and the sampling rate, so designs are cached and reused
+    whenever the same pair is requested again.
 
-        # adc-to-pressure conversions:
-        # Venturi 1 Pressure (patient-side during inspiration):
-        p1_ins_cmH2O = (25.4 / (14745 - 1638)) * (p1_ins_ADC - 1638)
-        p1_ins_Pa = p1_ins_cmH2O * 98.0665  # Converted to Pa
-
-        # Venturi 1 Pressure (patient-side during expiration):
-        p1_exp_cmH2O = (25.4 / (14745 - 1638)) * (p1_exp_ADC - 1638)
-        p1_exp_Pa = p1_exp_cmH2O * 98.0665  # Converted to Pa
-
-        # Venturi 1 Pressure (patient-side) at the constriction:
-        p2_cmH2O = (25.4 / (14745 - 1638)) * (p2_ADC - 1638)
-        p2_Pa = p2_cmH2O * 98.0665  # Converted to Pa
-
-        # flow_rate calculation:
-        p1_Pa = max(p1_ins_Pa, p1_exp_Pa)  # Upstream pressure
-        numerator = 2 * (p1_Pa - p2_Pa)
-        denominator = moist_air_density * ((A1 / A2) ** 2 - 1)
-        flow_rate = A1 * np.sqrt(numerator / denominator)
-        if p1_exp_Pa > p1_ins_Pa:
-            flow_rate *= -1
+    Args:
+        cutoff_freq (float): The cutoff frequency of the filter in Hz.
 
-        result.append([time, flow_rate])
+        sampling_rate (float): The sampling rate of the data in Hz.
 
-    return np.array(result)
+    Returns:
+        tuple: The numerator (b) and denominator (a) polynomial
+        coefficients of the filter.
+    """
+    return signal.iirfilter(2, Wn=cutoff_freq, fs=sampling_rate,
+                            btype="lowpass", ftype="butter", output="ba")
 
 
 def detect_peak_times(flow_rate_data):
@@ -189,18 +242,20 @@ def detect_peak_times(flow_rate_data):
     time = flow_rate_data[:, 0]
     flow_rate = flow_rate_data[:, 1]
 
-    # sampling rate calculated based on time intervals between samples:
-    time_diffs = np.diff(time)
-    avg_time_diff = np.mean(time_diffs)
-    sampling_rate = 1.0 / avg_time_diff
+    # sampling rate calculated based on time intervals between samples
+    # (the mean of the intervals is the total time over their count):
+    sampling_rate = (len(time) - 1) / (time[-1] - time[0])
     cutoff_freq = 2
 
-    # Creation of bandpass filter to smooth out noisy flow rate data:
-    sos = scipy.signal.iirfilter(2, Wn=cutoff_freq, fs=sampling_rate,
-                                 btype="lowpass", ftype="butter", output="sos")
+    # Creation of bandpass filter to smooth out noisy flow rate data
+    # (rounded so that jitter in the sample times reuses the design):
+    b, a = design_lowpass_filter(cutoff_freq, round(sampling_rate, 3))
 
-    # Applying the bandpass filter using sosfilt
-    filtered_flow_rate = scipy.signal.sosfilt(sos, flow_rate)
+    # Applying the bandpass filter using lfilter, with the coefficients
+    # in the precision of the data so float32 input stays float32:
+    filtered_flow_rate = signal.lfilter(b.astype(flow_rate.dtype, copy=False),
+                                        a.astype(flow_rate.dtype, copy=False),
+                                        flow_rate)
 
     # Parameters to adjust the sensitivity of peak detection:
     height = 0.00009  # Minimum height of peaks.
@@ -209,11 +264,11 @@ def detect_peak_times(flow_rate_data):
     width = None  # Minimum width of peaks in samples.
 
     # Detecting peaks in the filtered signal:
-    peaks, _ = scipy.signal.find_peaks(filtered_flow_rate,
-                                       height=height,
-                                       distance=distance,
-                                       prominence=prominence,
-                                       width=width)
+    peaks, _ = signal.find_peaks(filtered_flow_rate,
+                                 height=height,
+                                 distance=distance,
+                                 prominence=prominence,
+                                 width=width)
 
     # Getting the times at which these peaks occur:
     peak_times = time[peaks]
@@ -239,6 +294,10 @@ def plot_filtered_flow_rate_and_peaks(flow_rate_data,
         flow_rate_data (ndarray): 2D ndarray containing time
         in the first column and flow rate in the second.
     """
+    # Imported here so that the analysis itself does not pay the
+    # matplotlib import cost when plotting is disabled:
+    import matplotlib.pyplot as plt
+
     time = flow_rate_data[:, 0]
     flow_rate = flow_rate_data[:, 1]
 
@@ -298,8 +357,7 @@ def apnea_events(peak_times):
         the data.
     """
     intervals = np.diff(peak_times)
-    apnea_count = np.sum(intervals > 10)
-    return int(apnea_count)
+    return int(np.count_nonzero(intervals > 10))
 
 
 def calculate_leakage(flow_rate_data, logger):
@@ -320,7 +378,14 @@ def calculate_leakage(flow_rate_data, logger):
     """
     time = flow_rate_data[:, 0]
     q = flow_rate_data[:, 1]
-    leakage_m3 = np.trapz(q, x=time)  # Integral of q over t gives V in m^3
+
+    # Integral of q over t gives V in m^3 (trapezoidal rule):
+    dt = np.diff(time)
+    if dt.size and np.ptp(dt) <= 1e-9 * abs(dt[0]):
+        # Uniformly sampled data reduces to a single sum:
+        leakage_m3 = dt[0] * (q.sum() - 0.5 * (q[0] + q[-1]))
+    else:
+        leakage_m3 = 0.5 * np.dot(q[:-1] + q[1:], dt)
     leakage_liters = leakage_m3 * 1000  # Convert m^3 to liters
 
     if leakage_liters < 0:
@@ -352,17 +417,20 @@ def calculate_metrics(flow_rate_data, peak_times, apneas, leakage):
         of breaths, apnea count, and total leakage.
     """
     time = flow_rate_data[:, 0]
-    duration = time[-1] - time[0]
+    duration = float(time[-1] - time[0])
 
+    # NumPy values are converted to Python floats, since float32
+    # values cannot be serialized to JSON (tolist converts the whole
+    # array in one call):
     metrics = {
         "duration": round(duration, 3),
         "breaths": len(peak_times),
         "breath_rate_bpm": (
             round(len(peak_times) / (duration / 60) if duration > 0 else 0,
                   3)),
-        "breath_times": list(peak_times),
+        "breath_times": peak_times.tolist(),
         "apnea_count": apneas,
-        "leakage": round(leakage, 3)
+        "leakage": round(float(leakage), 3)
     }
     return metrics
 
@@ -373,8 +441,13 @@ def json_dump(filename, metrics):
     This function takes a filename and a dictionary of metrics,
     then creates a JSON file with the same base filename but with
     a .json extension. The metrics are written to this file in a
-    human-readable format with an indentation of 4 spaces, making
-    it easy to view the data structure.
+    human-readable indented format, making it easy to view the data
+    structure, with an indentation of 4 spaces. If the orjson package
+    is installed, it is used to serialize the metrics, and the leading
+    spaces of its 2-space indented lines are doubled; otherwise the
+    json module is used. Both write the same output for finite
+    metrics (non-finite values are written as null by orjson and as
+    NaN/Infinity by the json module).
 
     Args:
         filename (str): The base name for the output file, without an
@@ -397,8 +470,19 @@ def json_dump(filename, metrics):
         }
     """
     filename += '.json'
-    with open(filename, 'w') as file:
-        json.dump(metrics, file, indent=4)
+    if orjson is not None:
+        with open(filename, 'wb') as file:
+            # orjson only indents by 2 spaces. JSON strings cannot
+            # contain raw newlines, so the leading spaces of each line
+            # are all indentation
+            lines = orjson.dumps(metrics,
+                                 option=orjson.OPT_INDENT_2).split(b"\n")
+            file.write(b"\n".join(
+                line[:len(line) - len(line.lstrip(b" "))] + line
+                for line in lines))
+    else:
+        with open(filename, 'w') as file:
+            json.dump(metrics, file, indent=4)
 
 
 def main(filename):
@@ -444,6 +528,10 @@ def main(filename):
 
     - Saving the metrics dictionary to a JSON file for later analysis or
     reporting.
+
+    The raw and filtered flow rate plots are skipped unless the
+    CPAP_PLOT environment variable is set to a non-empty value, so
+    the analysis runs headless by default.
     """
     if filename[-4:] != '.txt':
         print("FileError: File must have the '.txt' extension")
@@ -468,8 +556,10 @@ def main(filename):
     flow_rate = flow_vs_time(data)
     peak_times, filtered_flow_rate = detect_peak_times(flow_rate)
 
-    # Un-comment the following line if you wish to plot:
-    # plot_filtered_flow_rate_and_peaks(flow_rate, peaks, filtered_flow_rate)
+    # Set the CPAP_PLOT environment variable if you wish to plot:
+    if os.environ.get('CPAP_PLOT'):
+        plot_filtered_flow_rate_and_peaks(flow_rate, peak_times,
+                                          filtered_flow_rate)
 
     apneas = apnea_events(peak_times)
     leakage = calculate_leakage(flow_rate, logger)
@@ -481,7 +571,9 @@ def main(filename):
 
 if __name__ == "__main__":
     target_folder = 'sample_data/'
-    for i in range(1, 9):
-        patient_filename = f'patient_{i:02}.txt'
-        path = target_folder + patient_filename
-        main(path)
+    paths = [target_folder + f'patient_{i:02}.txt' for i in range(1, 9)]
+
+    # Each patient is analyzed independently, so process them in parallel
+    # (list() re-raises any exception from a worker process):
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(main, paths))
@@ -1,18 +1,31 @@
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
-import cpap_analysis as ca
-import logging
+from tkinter import ttk
 import requests
 from PIL import Image, ImageTk
-import base64
-import io
-import matplotlib.image as mpimg
+import binascii
+import re
 from io import BytesIO
-from datetime import datetime
-
-image_size = 350
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to requests' json
+    orjson = None
 
+image_size = 350
+# (connect, read) timeouts in seconds for every request, so that a
+# hung request does not hold up the single worker thread
+request_timeout = (3, 10)
+# dates as sent by the server, e.g. 'Mon, 18 Apr 2024 12:00:35 GMT'
+http_date = re.compile(
+    r"[A-Za-z]{3}, (\d{2}) ([A-Za-z]{3}) (\d{4}) (\d{2}:\d{2}:\d{2}) GMT")
+months = {"Jan": "01", "Feb": "02", "Mar": "03", "Apr": "04",
+          "May": "05", "Jun": "06", "Jul": "07", "Aug": "08",
+          "Sep": "09", "Oct": "10", "Nov": "11", "Dec": "12"}
+
+
+@lru_cache(maxsize=4096)
 def convert_date_string(input_string):
     """Convert a date string from one format to another.
 
@@ -22,24 +35,46 @@ def convert_date_string(input_string):
     not in the expected format, the function returns a
     default date string.
 
+    The format is fixed, so the string is split with a
+    precompiled regular expression instead of datetime.strptime,
+    which parses the format again on every call. This runs for
+    every datetime of the selected patient on each refresh, so the
+    results are also cached, and datetimes seen in an earlier
+    refresh are not converted again.
+
     :param input_string: str containing the date string
                          to convert
 
     :return: str containing the converted date string
     """
-    # Parse the input string into a datetime object
-    try:
-        input_datetime = datetime.strptime(
-            input_string, '%a, %d %b %Y %H:%M:%S %Z')
-    except ValueError:
+    match = http_date.fullmatch(input_string)
+    if match is None or match[2] not in months:
         print("invalid datetime format")
         return '2000-01-01 12:00:00'
-    # Format the datetime object into the desired output format
-    output_string = input_datetime.strftime('%Y-%m-%d %H:%M:%S')
+    day, month, year, time = match.groups()
+    # Reorder the fields into the desired output format
+    output_string = f"{year}-{months[month]}-{day} {time}"
 
     return output_string
 
 
+def parse_json(response):
+    """Decode the JSON body of a server response.
+
+    If the orjson package is installed, it is used to parse the
+    body, which is faster on the long base64 plot strings;
+    otherwise the response's own json method is used.
+
+    :param response: requests.Response object received from the
+                     server
+
+    :return: the decoded JSON content of the response
+    """
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
 def save_plot(b64_str, value='lorem', mrn='ipsum', noname=True):
     """Save a plot image from a base64-encoded string.
 
@@ -59,10 +94,30 @@ def save_plot(b64_str, value='lorem', mrn='ipsum', noname=True):
     if len(b64_str) < 10:
         print("no plot to save")
         return
+    write_plot(binascii.a2b_base64(b64_str), value, mrn, noname)
+
+
+def write_plot(image_bytes, value='lorem', mrn='ipsum', noname=True):
+    """Save an already decoded plot image to a file.
+
+    This function works like save_plot, but takes the image bytes
+    directly so that a plot which has already been decoded for
+    display does not need to be decoded again.
+
+    :param image_bytes: bytes containing the plot image
+    :param value: str containing the value to include in the
+                  filename (default: 'lorem')
+    :param mrn: str containing the MRN to include in the filename
+                (default: 'ipsum')
+    :param noname: bool indicating whether to use a default
+                   filename (default: True)
+    """
+    if not image_bytes:
+        print("no plot to save")
+        return
     if value == '' or mrn == '':
         print("no image to save")
         return
-    image_bytes = base64.b64decode(b64_str)
     if not noname:
         new_filename = f"{mrn}, {value}"
     else:
@@ -83,14 +138,82 @@ def main():
 
     The function sets up periodic tasks using the after method
     to fetch room numbers and datetimes from the server at
-    regular intervals.
+    regular intervals. All requests share one requests.Session
+    so the connection to the server is kept alive between them,
+    and are sent from a worker thread so that a slow server does
+    not freeze the GUI.
 
     Finally, it starts the Tkinter event loop to display the
     GUI and handle user interactions.
     """
 
+    session = requests.Session()
+    # a single worker keeps the responses in the order they were sent
+    executor = ThreadPoolExecutor(max_workers=1)
     occupied_rooms = ()
     valid_datetimes = ()
+    # ETags of the last room/datetime lists received from the server
+    rooms_etag = None
+    datetimes_etag = None
+    # nis.png is only read and resized once
+    default_pil_image = None
+    # after ids of the debounced callbacks waiting to run
+    pending_calls = {}
+    # plots as decoded for display, written out by the save buttons
+    decoded_plots = {"current": b"", "historic": b""}
+
+    def run_in_background(request, apply, on_error=None):
+        """Send a request from the worker thread and apply the result
+           on the Tk thread.
+
+        Tk widgets and variables may only be used from the thread
+        running the main loop, so request must not touch them. Its
+        return value is handed to apply through the after method.
+        If request raises, for example because the server cannot be
+        reached, the error is printed and on_error is called on the
+        Tk thread instead, so that a polling caller can schedule its
+        next poll.
+
+        :param request: callable without arguments that sends the
+                        request and returns its result
+        :param apply: callable taking the result of request that
+                      updates the GUI
+        :param on_error: callable without arguments to call if
+                         request raised (default: None)
+        """
+        def on_done(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"request failed: {e}")
+                if on_error is not None:
+                    root.after(0, on_error)
+                return
+            root.after(0, apply, result)
+
+        executor.submit(request).add_done_callback(on_done)
+
+    def debounce(callback, delay=150):
+        """Wrap a trace callback so that a burst of writes runs it once.
+
+        Every write cancels the call scheduled by the previous one,
+        so callback only runs once the traced variable has stayed
+        unchanged for delay milliseconds.
+
+        :param callback: trace callback taking the name, index and
+                         mode of the traced variable
+        :param delay: int containing the number of milliseconds to
+                      wait (default: 150)
+
+        :return: trace callback to pass to trace_add
+        """
+        def handler(name, index, mode):
+            if callback in pending_calls:
+                root.after_cancel(pending_calls[callback])
+            pending_calls[callback] = root.after(
+                delay, callback, name, index, mode)
+
+        return handler
 
     def fetch_room_numbers():
         """Fetch occupied room numbers from the server.
@@ -103,14 +226,29 @@ def main():
 
         The function is set to be called repeatedly every
         1000 milliseconds (1 second) using the after
-        method.
+        method. The ETag of the last list received is sent
+        with each request; if the rooms have not changed, the
+        server answers 304 Not Modified and the dropdown is
+        left as it is.
         """
         """api request to server to get rooms"""
-        nonlocal occupied_rooms
-        r = requests.get(f"http://{INSTANCEURL}/fetch_room_numbers")
-        occupied_rooms = tuple(r.json())
-        room_select_dropdown['values'] = occupied_rooms
-        root.after(1000, fetch_room_numbers)
+        headers = {"If-None-Match": rooms_etag} if rooms_etag else {}
+
+        def poll_again():
+            root.after(1000, fetch_room_numbers)
+
+        def show(r):
+            nonlocal occupied_rooms, rooms_etag
+            poll_again()
+            if r.status_code != 304:
+                occupied_rooms = tuple(parse_json(r))
+                room_select_dropdown['values'] = occupied_rooms
+                rooms_etag = r.headers.get("ETag")
+
+        run_in_background(
+            lambda: session.get(f"http://{INSTANCEURL}/fetch_room_numbers",
+                                headers=headers, timeout=request_timeout),
+            show, poll_again)
 
     def display_cpap_calculated_data(name, index, mode):
         """Displays the br, apnea count, and q vs t graph
@@ -121,7 +259,10 @@ def main():
         the room number. It updates the GUI elements with
         the retrieved data, including the MRN, patient name,
         record creation timestamp, CPAP pressure, breathing
-        rate, apnea events, and the flow rate plot.
+        rate, apnea events, and the flow rate plot. The
+        patient's datetimes come with the same response, so the
+        datetime dropdown is filled without waiting for the next
+        fetch_datetimes poll.
 
         If the number of apnea events is greater than or equal
         to 2, the apnea event text is highlighted in red.
@@ -133,70 +274,94 @@ def main():
         :param mode: str containing the mode of the traced
                      variable
         """
-        url = f"http://{INSTANCEURL}/fetch_cpap_calculated_data"
+        url = f"http://{INSTANCEURL}/fetch_patient_snapshot"
         if room_select_var.get() != '':
             room_num = {"room_number": int(room_select_var.get())}
-            r = requests.post(url, json=room_num)
-            r = r.json()
-            patient_mrn_var.set(r[0])
-            cpap_metrics_var.set(
-                (f"MRN: {r[0]}\n"
-                 f"Name: {r[1]}\n"
-                 f"Record created: {r[2]}\n"
-                 f"CPAP Pressue (cmH\N{SUBSCRIPT TWO}O): {r[3]}\n"
-                 f"Breathing rate: {r[4]}\n"
-                 f"Apnea events: {r[5]}"))
-            cpap_current_var.set(r[2])
-            cpap_plot_var_b64.set(r[6])
-            patient_info.delete("1.0", tk.END)
-            patient_info.insert(tk.END, cpap_metrics_var.get())
-            if r[5] >= 2:
-                patient_info.tag_add("line", f"{6}.0", f"{6}.end")
-                patient_info.tag_config("line", foreground='red')
-            else:
-                patient_info.tag_add("line", f"{6}.0", f"{6}.end")
-                patient_info.tag_config(
-                    "line", foreground=patient_info.cget("foreground"))
+
+            def show(snapshot):
+                nonlocal valid_datetimes
+                r = snapshot["metrics"]
+                valid_datetimes = tuple(convert_date_string(dt)
+                                        for dt in snapshot["datetimes"])
+                dt_dropdown['values'] = valid_datetimes
+                patient_mrn_var.set(r[0])
+                cpap_metrics_var.set(
+                    (f"MRN: {r[0]}\n"
+                     f"Name: {r[1]}\n"
+                     f"Record created: {r[2]}\n"
+                     f"CPAP Pressue (cmH\N{SUBSCRIPT TWO}O): {r[3]}\n"
+                     f"Breathing rate: {r[4]}\n"
+                     f"Apnea events: {r[5]}"))
+                cpap_current_var.set(r[2])
+                cpap_plot_var_b64.set(r[6])
+                patient_info.delete("1.0", tk.END)
+                patient_info.insert(tk.END, cpap_metrics_var.get())
+                if r[5] >= 2:
+                    patient_info.tag_add("line", f"{6}.0", f"{6}.end")
+                    patient_info.tag_config("line", foreground='red')
+                else:
+                    patient_info.tag_add("line", f"{6}.0", f"{6}.end")
+                    patient_info.tag_config(
+                        "line", foreground=patient_info.cget("foreground"))
+                plot_cpap(r[6])
+
+            run_in_background(
+                lambda: parse_json(session.post(url, json=room_num,
+                                                timeout=request_timeout)),
+                show)
 
             # code to plot dummy images, set dt_var to ''
 
-    def plot_cpap(name, index, mode):
+    def plot_cpap(b64_str):
         """Plot the flow rate data for the selected patient.
 
-        This function retrieves the base64-encoded flow rate
-        plot from the traced variable and decodes it into an
-        image. It then resizes the image to fit the specified
-        dimensions and displays it in the GUI using a Tkinter
-        Label.
+        This function decodes the base64-encoded flow rate plot
+        into an image. It then resizes the image to fit the
+        specified dimensions and displays it in the GUI using a
+        Tkinter Label.
+
+        It is called by display_cpap_calculated_data once all
+        of the patient's text fields have been updated.
 
         If the decoded data is not a valid image, a default
         image is displayed instead.
 
-        :param name: str containing the name of the traced
-                     variable
-        :param index: str containing the index of the traced
-                      variable
-        :param mode: str containing the mode of the traced
-                     variable
+        :param b64_str: str containing the base64-encoded plot
         """
-        image_bytes = base64.b64decode(cpap_plot_var_b64.get())
+        image_bytes = binascii.a2b_base64(b64_str)
+        decoded_plots["current"] = image_bytes
         try:
             image = Image.open(BytesIO(image_bytes))
         except BaseException:
             print("bad file format")
-            image = load_and_size_image()
-            photo_image = ImageTk.PhotoImage(image)
-            # Create a Tkinter Label to display the image
-            image_label.config(image=photo_image)
-            image_label.image = photo_image
+            image_label.config(image=default_tk_image)
+            image_label.image = default_tk_image
             return
         image = load_and_size_image(image)
+        show_image(image_label, image)
+
+    def show_image(label, pil_image):
+        """Display an image on a Tkinter Label.
 
-        photo_image = ImageTk.PhotoImage(image)
+        If the label already shows a PhotoImage of the same size,
+        the new pixels are pasted into it in place instead of
+        allocating a new PhotoImage. The default image is shared by
+        all the labels, so it is never pasted into.
+
+        :param label: ttk.Label to display the image on
+        :param pil_image: PIL.Image object containing the image
+        """
+        photo_image = label.image
+        if (photo_image is not default_tk_image
+                and (photo_image.width(), photo_image.height())
+                == pil_image.size):
+            photo_image.paste(pil_image)
+            return
+        photo_image = ImageTk.PhotoImage(pil_image)
 
         # Create a Tkinter Label to display the image
-        image_label.config(image=photo_image)
-        image_label.image = photo_image
+        label.config(image=photo_image)
+        label.image = photo_image
 
     def load_and_size_image(filename=None):
         """Load an image file and resize it to fit the specified
@@ -205,17 +370,29 @@ def main():
         This function loads an image file and resizes it to fit
         within the specified width and height dimensions while
         maintaining the aspect ratio. If no filename is provided,
-        a default image is loaded.
+        a default image is loaded. The default image is only loaded
+        and resized on the first call and reused afterwards.
+
+        JPEG plots are decoded directly at a reduced scale close to
+        the final size through draft, which has no effect on PNGs.
+        Palette PNG plots are converted to RGB first, as Pillow would
+        otherwise resize them without interpolation.
 
         :param filename: str containing the path to the image
                          file (default: None)
 
         :return: PIL.Image object containing the resized image
         """
+        nonlocal default_pil_image
         if filename is None:
-            raw_pil_image = Image.open("nis.png")
-        else:
-            raw_pil_image = filename
+            if default_pil_image is None:
+                default_pil_image = load_and_size_image(
+                    Image.open("nis.png"))
+            return default_pil_image
+        raw_pil_image = filename
+        raw_pil_image.draft("RGB", (image_size, image_size))
+        if raw_pil_image.mode == "P":
+            raw_pil_image = raw_pil_image.convert("RGB")
         final_width = image_size
         final_height = image_size
         alpha_x = final_width / raw_pil_image.size[0]
@@ -223,7 +400,8 @@ def main():
         alpha = min(alpha_x, alpha_y)
         new_x = round(raw_pil_image.size[0] * alpha)
         new_y = round(raw_pil_image.size[1] * alpha)
-        pil_image = raw_pil_image.resize((new_x, new_y))
+        pil_image = raw_pil_image.resize((new_x, new_y),
+                                         Image.Resampling.BILINEAR)
         return pil_image
 
     def fetch_datetimes():
@@ -238,29 +416,68 @@ def main():
 
         The function is set to be called repeatedly every
         1000 milliseconds (1 second) using the after method.
+        If the datetimes have not changed since the last request,
+        the server answers 304 Not Modified and the dropdown is
+        left as it is.
         """
-        nonlocal valid_datetimes
-        if patient_mrn_var.get() != 0:
-            out_json = {"mrn": patient_mrn_var.get()}
-            r = requests.post(
+        if patient_mrn_var.get() == 0:
+            root.after(1000, fetch_datetimes)
+            return
+        out_json = {"mrn": patient_mrn_var.get()}
+        headers = ({"If-None-Match": datetimes_etag}
+                   if datetimes_etag else {})
+
+        def poll_again():
+            root.after(1000, fetch_datetimes)
+
+        def show(r):
+            nonlocal valid_datetimes, datetimes_etag
+            poll_again()
+            if r.status_code != 304:
+                datetimes_etag = r.headers.get("ETag")
+                r = parse_json(r)
+                valid_datetimes = [convert_date_string(dt) for dt in r]
+                valid_datetimes = tuple(valid_datetimes)
+                dt_dropdown['values'] = valid_datetimes
+
+        run_in_background(
+            lambda: session.post(
                 f"http://{INSTANCEURL}/fetch_datetimes_for_patient",
-                json=out_json)
-            r = r.json()
-            valid_datetimes = [convert_date_string(dt) for dt in r]
-            valid_datetimes = tuple(valid_datetimes)
-            dt_dropdown['values'] = valid_datetimes
-        root.after(1000, fetch_datetimes)
+                json=out_json, headers=headers, timeout=request_timeout),
+            show, poll_again)
+
+    @lru_cache(maxsize=64)
+    def fetch_historic_plot(mrn, dt):
+        """Fetch, decode and resize a historic plot of a patient.
+
+        Records do not change once uploaded, so the results are
+        kept in an LRU cache and selecting the same datetime again
+        does not go back to the server. This runs on the worker
+        thread and does not touch any Tk widget.
+
+        :param mrn: int containing the MRN of the patient
+        :param dt: str containing the datetime of the record
+
+        :return: tuple of the decoded plot bytes and the resized
+                 PIL.Image object
+        """
+        url = f"http://{INSTANCEURL}/fetch_plot_from_datetime_and_mrn"
+        out_json = {"datetime": dt, "mrn": mrn}
+        r = parse_json(session.post(url, json=out_json,
+                                    timeout=request_timeout))
+        image_bytes = binascii.a2b_base64(r)
+        image = load_and_size_image(Image.open(BytesIO(image_bytes)))
+        return image_bytes, image
 
     def plot_both(name, index, mode):
         """Plot the current and historical flow rate data for
            the selected patient.
 
-        This function retrieves the current and historical
-        flow rate plots from the server based on the selected
-        datetime and MRN. It decodes the base64-encoded plot
-        data into images, resizes the images to fit the
-        specified dimensions, and displays them in the GUI
-        using Tkinter Labels.
+        This function retrieves the historical flow rate plot
+        for the selected datetime and MRN through
+        fetch_historic_plot, and displays it in the GUI using a
+        Tkinter Label. The current plot is already shown by
+        plot_cpap, so its image is reused as is.
 
         :param name: str containing the name of the traced
                      variable
@@ -269,35 +486,23 @@ def main():
         :param mode: str containing the mode of the traced
                      variable
         """
-        url = f"http://{INSTANCEURL}/fetch_plot_from_datetime_and_mrn"
         if dt_select_var.get() != '':
-            out_json = {"datetime": dt_select_var.get(),
-                        "mrn": patient_mrn_var.get()}
-            r = requests.post(url, json=out_json)
-            r = r.json()
-            cpap_plot_historic_var_b64.set(r)
-
-            image_bytes = base64.b64decode(cpap_plot_var_b64.get())
-            image = Image.open(BytesIO(image_bytes))
-            image = load_and_size_image(image)
+            mrn = patient_mrn_var.get()
+            dt = dt_select_var.get()
 
-            photo_image = ImageTk.PhotoImage(image)
+            def show(plot):
+                if dt_select_var.get() != dt:
+                    # the selection was changed or reset meanwhile
+                    return
+                image_bytes, image = plot
 
-            # Create a Tkinter Label to display the image
-            image_label2.config(image=photo_image)
-            image_label2.image = photo_image
+                image_label2.config(image=image_label.image)
+                image_label2.image = image_label.image
 
-            ######
+                decoded_plots["historic"] = image_bytes
+                show_image(image_label3, image)
 
-            image_bytes = base64.b64decode(cpap_plot_historic_var_b64.get())
-            image = Image.open(BytesIO(image_bytes))
-            image = load_and_size_image(image)
-
-            photo_image = ImageTk.PhotoImage(image)
-
-            # Create a Tkinter Label to display the image
-            image_label3.config(image=photo_image)
-            image_label3.image = photo_image
+            run_in_background(lambda: fetch_historic_plot(mrn, dt), show)
 
     def send_cpap():
         """Send the updated CPAP pressure to the server for the
@@ -326,7 +531,8 @@ def main():
             print("CPAP value must be between 4 and 25")
             return
         out_json = {"room_number": int(room_select_var.get()), "cpap": value}
-        r = requests.post(url, json=out_json)
+        executor.submit(session.post, url, json=out_json,
+                        timeout=request_timeout)
 
     def reset(name, index, mode):
         """Reset the GUI elements to their default state.
@@ -341,18 +547,30 @@ def main():
         :param mode: str containing the mode of the traced variable
         """
         dt_select_var.set('')
-        cpap_plot_historic_var_b64.set('')
+        decoded_plots["historic"] = b""
         update_cpap_var.set('')
 
-        pil_image2 = load_and_size_image()
-        tk_image2 = ImageTk.PhotoImage(pil_image2)
-        image_label2.config(image=tk_image2)
-        image_label2.image = tk_image2
+        image_label2.config(image=default_tk_image)
+        image_label2.image = default_tk_image
+
+        image_label3.config(image=default_tk_image)
+        image_label3.image = default_tk_image
 
-        pil_image3 = load_and_size_image()
-        tk_image3 = ImageTk.PhotoImage(pil_image3)
-        image_label3.config(image=tk_image3)
-        image_label3.image = tk_image3
+    display_room_data = debounce(display_cpap_calculated_data)
+
+    def on_room_change(name, index, mode):
+        """Reset the GUI and show the data of the selected room.
+
+        This is the only callback traced on the room selection,
+        so the GUI is always reset before the data of the new
+        room is requested.
+
+        :param name: str containing the name of the traced variable
+        :param index: str containing the index of the traced variable
+        :param mode: str containing the mode of the traced variable
+        """
+        reset(name, index, mode)
+        display_room_data(name, index, mode)
 
     root = tk.Tk()
     root.title("Monitoring Station")
@@ -387,10 +605,10 @@ def main():
     # plot display
 
     cpap_plot_var_b64 = tk.StringVar()
-    pil_image = load_and_size_image()
-    tk_image = ImageTk.PhotoImage(pil_image)
-    image_label = ttk.Label(root, image=tk_image)
-    image_label.image = tk_image
+    # shared by every label that is not showing a plot
+    default_tk_image = ImageTk.PhotoImage(load_and_size_image())
+    image_label = ttk.Label(root, image=default_tk_image)
+    image_label.image = default_tk_image
     image_label.grid(row=0, column=2, padx=padding,
                      pady=padding, rowspan=3, columnspan=2)
 
@@ -415,17 +633,12 @@ def main():
         row=5, column=1, padx=3*padding, pady=3*padding)
 
     # display historical plot
-    pil_image2 = load_and_size_image()
-    tk_image2 = ImageTk.PhotoImage(pil_image2)
-    image_label2 = ttk.Label(root, image=tk_image2)
-    image_label2.image = tk_image2
+    image_label2 = ttk.Label(root, image=default_tk_image)
+    image_label2.image = default_tk_image
     image_label2.grid(row=6, column=0, rowspan=3, columnspan=2)
 
-    cpap_plot_historic_var_b64 = tk.StringVar()
-    pil_image3 = load_and_size_image()
-    tk_image3 = ImageTk.PhotoImage(pil_image3)
-    image_label3 = ttk.Label(root, image=tk_image3)
-    image_label3.image = tk_image3
+    image_label3 = ttk.Label(root, image=default_tk_image)
+    image_label3.image = default_tk_image
     image_label3.grid(row=6, column=2, rowspan=3, columnspan=2)
 
     # left/right labels
@@ -441,14 +654,14 @@ def main():
 
     cpap_current_var = tk.StringVar()
     save_current = ttk.Button(root, text="Save current plot",
-                              command=lambda: save_plot(
-                                  cpap_plot_var_b64.get(),
+                              command=lambda: executor.submit(
+                                  write_plot, decoded_plots["current"],
                                   convert_date_string(cpap_current_var.get()),
                                   patient_mrn_var.get(), noname=False))
     save_current.grid(row=10, column=0, columnspan=2, pady=10)
     save_historic = ttk.Button(root, text="Save historic plot",
-                               command=lambda: save_plot(
-                                   cpap_plot_historic_var_b64.get(),
+                               command=lambda: executor.submit(
+                                   write_plot, decoded_plots["historic"],
                                    dt_select_var.get(),
                                    patient_mrn_var.get(), noname=False))
     save_historic.grid(row=10, column=2, columnspan=2, pady=10)
@@ -467,15 +680,15 @@ def main():
 
     root.after(1000, fetch_room_numbers)
     # root.after(1000, fetch_datetimes)
-    room_select_var.trace_add("write", display_cpap_calculated_data)
-    room_select_var.trace_add("write", reset)
-    cpap_plot_var_b64.trace_add("write", plot_cpap)
+    room_select_var.trace_add("write", on_room_change)
     # patient_mrn_var.trace_add("write", fetch_datetimes)
     root.after(1000, fetch_datetimes)
     # may need to dynamicaly call fetch_dt
-    dt_select_var.trace_add("write", plot_both)
+    dt_select_var.trace_add("write", debounce(plot_both))
 
     root.mainloop()
+    executor.shutdown(wait=False)
+    session.close()
 
 
 if __name__ == "__main__":
@@ -4,19 +4,155 @@ import cpap_analysis as ca
 import logging
 from PIL import Image, ImageTk
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import io
 import requests
 from datetime import datetime
 import json
 import os
+import sys
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the json module
+    orjson = None
 
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# One session for all requests to the server, so that the connection
+# is kept alive between uploads, updates and the periodic CPAP check
+session = requests.Session()
+# (connect, read) timeouts in seconds for every request
+request_timeout = (3, 10)
+# Worker thread for the requests sent without user interaction
+executor = ThreadPoolExecutor(max_workers=1)
+# Worker thread for the analysis of the selected CPAP data files
+analysis_executor = ThreadPoolExecutor(max_workers=1)
+
+# Figure, Agg canvas, axes and line of the flow rate plot, created on
+# the first call to display_metrics and reused by every later one
+plot_figure = None
+plot_canvas = None
+plot_axes = None
+plot_line = None
+
+
+def run_on_tk_thread(root, func, *args):
+    """Schedule a call on the Tk thread from a worker thread.
+
+    This function is used as the done callback of the requests and
+    analyses run on the worker threads. If the window has already
+    been closed, the call is dropped instead of raising in the
+    worker thread.
+
+    :param root: tk.Tk root window
+    :param func: the function to call on the Tk thread
+    :param *args: the arguments to call func with
+    """
+    try:
+        root.after(0, func, *args)
+    except (RuntimeError, tk.TclError):
+        pass  # the window has been closed
+
 
-def select_cpap_file():
+def dump_json(data):
+    """Serialize the data of a request to the server as JSON.
+
+    If the orjson package is installed, it is used to serialize the
+    data, which returns bytes directly; otherwise the json module
+    is used.
+
+    :param data: dict containing the data to send to the server
+
+    :return: bytes or str containing the JSON representation of data
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data)
+
+
+def parse_json(response):
+    """Decode the JSON body of a server response.
+
+    If the orjson package is installed, it is used to parse the
+    body; otherwise the response's own json method is used. The
+    body is parsed once, and the success and error handling of the
+    caller both work on the result.
+
+    :param response: requests.Response object received from the
+                     server
+
+    :return: the decoded JSON content of the response, or None if
+             the body is not valid JSON
+    """
+    try:
+        if orjson is not None:
+            return orjson.loads(response.content)
+        return response.json()
+    except ValueError:
+        return None
+
+
+def post_data(url, data, plot=None, headers=None):
+    """Send data, and optionally the plot, to the server.
+
+    This function posts the data as the JSON "data" part of a
+    multipart request, like every endpoint of the server expects,
+    using the shared session and request timeout.
+
+    :param url: str containing the URL of the endpoint
+    :param data: dict containing the data to send
+    :param plot: bytes containing the PNG encoded plot, or None
+    :param headers: dict containing additional request headers
+
+    :return: requests.Response object received from the server
+    """
+    files = {"data": ("data.json", dump_json(data), "application/json")}
+    if plot is not None:
+        files["plot"] = ("plot.png", plot, "image/png")
+    return session.post(url, files=files, headers=headers,
+                        timeout=request_timeout)
+
+
+def decimate_flow_rate(flow_rate, n_buckets):
+    """Reduce the flow rate data to the envelope drawn in the plot.
+
+    The samples are split into n_buckets consecutive buckets and only
+    the minimum and maximum flow rate of each bucket are kept, in the
+    order they were sampled. With one bucket per pixel column of the
+    plot, the drawn line looks the same as with every sample, but
+    rendering no longer depends on the length of the session.
+
+    :param flow_rate: numpy array with the time in the first column
+                      and the flow rate in the second column
+    :param n_buckets: int containing the number of buckets
+
+    :return: numpy array with at most 2 * n_buckets rows of flow_rate
+    """
+    n = len(flow_rate)
+    if n <= 2 * n_buckets:
+        return flow_rate
+
+    # Index the samples as (bucket, sample) and repeat the last sample
+    # to fill up the last bucket
+    size = -(-n // n_buckets)
+    indices = np.minimum(np.arange(-(-n // size) * size), n - 1)
+    indices = indices.reshape(-1, size)
+    values = flow_rate[indices, 1]
+    rows = np.arange(len(indices))
+    lowest = indices[rows, values.argmin(axis=1)]
+    highest = indices[rows, values.argmax(axis=1)]
+    picks = np.sort(np.stack((lowest, highest), axis=1), axis=1)
+    return flow_rate[picks.ravel()]
+
+
+def select_cpap_file(parent=None):
     """Open a file dialog to select a CPAP data file.
 
     This function opens a file dialog window that allows
@@ -25,20 +161,21 @@ def select_cpap_file():
     a string. If no file is selected, the function returns
     None.
 
+    :param parent: tk.Tk root window the dialog belongs to; the
+                   default root window is used if not given
+
     :return: str containing the path to the selected
              file, or None if no file was selected
     """
-    root = tk.Tk()
-    root.withdraw()  # Hide the main window
-
     file_path = filedialog.askopenfilename(
+        parent=parent,
         title="Select CPAP Data File",
         filetypes=[("Text Files", "*.txt")]
     )
     return file_path
 
 
-def process_cpap_data(file_path):
+def process_cpap_data(file_path, show_error=True):
     """Process the CPAP data file and calculate metrics.
 
     This function takes the path to a CPAP data file and
@@ -50,6 +187,9 @@ def process_cpap_data(file_path):
 
     :param file_path: str containing the path to the
                       CPAP data file
+    :param show_error: bool indicating whether to show an error
+                       dialog if processing fails; pass False when
+                       running outside of the Tk thread
 
     :return: dict containing the calculated metrics,
              or None if an error occurred
@@ -59,7 +199,9 @@ def process_cpap_data(file_path):
                          "os.PathLike object, not NoneType"))
 
     try:
-        data = ca.data_acquisition(file_path, logger)
+        # The ADC counts are exact in single precision, and breath rate
+        # and apnea count come out the same as with float64
+        data = ca.data_acquisition(file_path, logger, dtype=np.float32)
         flow_rate = ca.flow_vs_time(data)
         peak_times, filtered_flow_rate = ca.detect_peak_times(flow_rate)
         apneas = ca.apnea_events(peak_times)
@@ -73,12 +215,20 @@ def process_cpap_data(file_path):
         return metrics
     except Exception as e:
         logger.error("Failed to process CPAP data: %s", e)
-        messagebox.showerror("Error",
-                             "Failed to process CPAP data."
-                             " Check the log for details.")
+        if show_error:
+            show_processing_error()
         return None
 
 
+def show_processing_error():
+    """Tell the user that the selected CPAP data file could not be
+    processed.
+    """
+    messagebox.showerror("Error",
+                         "Failed to process CPAP data."
+                         " Check the log for details.")
+
+
 def display_metrics(root, metrics, flow_rate, breathing_rate_label,
                     apnea_count_label, plot_label):
     """Display the calculated metrics and flow rate plot in the GUI.
@@ -87,7 +237,14 @@ def display_metrics(root, metrics, flow_rate, breathing_rate_label,
     and updates the corresponding GUI elements to display the
     information. The breathing rate and apnea count are displayed
     in their respective labels, and the flow rate data is plotted
-    and displayed in the plot label.
+    and displayed in the plot label. The Matplotlib figure is only
+    created once; later calls replace the data of its line.
+
+    The rendered plot is also encoded once and stored in
+    metrics['plot_bytes'], which upload_data and update_data send
+    to the server. A line plot only needs a few colors, so it is
+    encoded as a 16-color palette PNG, which is sharper than a JPEG
+    and less than half its size.
 
     :param root: tk.Tk root window
     :param metrics: dict containing the calculated metrics
@@ -107,23 +264,46 @@ def display_metrics(root, metrics, flow_rate, breathing_rate_label,
         apnea_count_label.config(text=f"Apneas: {apnea_count}",
                                  foreground=apnea_color)
 
-        # Create a Matplotlib figure and plot the flow rate vs. time
-        fig, ax = plt.subplots(figsize=(6, 4), dpi=75)
-        ax.plot(flow_rate[:, 0], flow_rate[:, 1], label='Flow Rate')
-        ax.set_title("Flow Rate vs. Time")
-        ax.set_xlabel("t (s)")
-        ax.set_ylabel("Q (m³/sec)")
+        global plot_figure, plot_canvas, plot_axes, plot_line
+        if plot_figure is None:
+            # Create the Matplotlib figure for the flow rate vs. time
+            plot_figure, plot_axes = plt.subplots(figsize=(6, 4), dpi=75)
+            # Render it with Agg whatever the pyplot backend is, since
+            # the plot is only ever shown as an image
+            plot_canvas = (plot_figure.canvas
+                           if isinstance(plot_figure.canvas, FigureCanvasAgg)
+                           else FigureCanvasAgg(plot_figure))
+            plot_line, = plot_axes.plot([], [], label='Flow Rate')
+            plot_axes.set_title("Flow Rate vs. Time")
+            plot_axes.set_xlabel("t (s)")
+            plot_axes.set_ylabel("Q (m³/sec)")
+            plot_axes.grid(True)
+            # Fixed margins that fit the tick labels of every sample
+            # session, instead of a tight_layout pass on every redraw
+            plot_figure.subplots_adjust(left=0.18, right=0.97,
+                                        top=0.9, bottom=0.15)
+        fig, ax = plot_figure, plot_axes
+        # One minimum and one maximum per pixel column of the figure
+        envelope = decimate_flow_rate(
+            flow_rate, int(fig.get_size_inches()[0] * fig.dpi))
+        plot_line.set_data(envelope[:, 0], envelope[:, 1])
         ax.set_xlim(0, flow_rate[-1, 0])
-        ax.grid(True)
-        fig.tight_layout()
+        ax.relim()
+        ax.autoscale_view(scalex=False)
 
-        # Save the plot as an image file in memory
-        img_buf = io.BytesIO()
-        fig.savefig(img_buf, format='png')
-        img_buf.seek(0)
+        # Render the plot and wrap the canvas' RGBA buffer with PIL,
+        # without encoding it to PNG and decoding it back
+        plot_canvas.draw()
+        plot_image = Image.frombuffer("RGBA", plot_canvas.get_width_height(),
+                                      plot_canvas.buffer_rgba(),
+                                      "raw", "RGBA", 0, 1)
 
-        # Open the image file using PIL
-        plot_image = Image.open(img_buf)
+        # Encode the plot for the uploads from the same rendering
+        plot_data = io.BytesIO()
+        plot_image.convert("RGB").quantize(
+            colors=16, method=Image.Quantize.FASTOCTREE).save(
+                plot_data, format="PNG")
+        metrics['plot_bytes'] = plot_data.getvalue()
 
         # Convert the PIL image to a PhotoImage for displaying in the GUI
         plot_photo = ImageTk.PhotoImage(plot_image)
@@ -137,18 +317,51 @@ def display_metrics(root, metrics, flow_rate, breathing_rate_label,
                              "Failed to display CPAP data analysis results.")
 
 
+def post_in_background(root, patient_info, on_reply, url, data, plot=None):
+    """Send data to the server from the worker thread.
+
+    The request is posted with post_data on the worker thread, so
+    that the GUI stays responsive while waiting for the server. Once
+    it has completed, on_reply is called on the Tk thread with the
+    concurrent.futures.Future holding the response. The request is
+    kept in patient_info until then, so that the reply is ignored if
+    the fields are reset in the meantime.
+
+    :param root: tk.Tk root window
+    :param patient_info: dict containing patient information
+    :param on_reply: function called with the future of the request
+    :param url: str containing the URL of the endpoint
+    :param data: dict containing the data to send
+    :param plot: bytes containing the PNG encoded plot, or None
+    """
+    def reply(future):
+        if patient_info.get('request') is future:
+            del patient_info['request']
+            on_reply(future)
+
+    future = executor.submit(post_data, url, data, plot)
+    patient_info['request'] = future
+    future.add_done_callback(
+        lambda future: run_on_tk_thread(root, reply, future))
+
+
 def upload_data(root, patient_info, metrics, mrn_entry,
                 room_number_entry, upload_button,
                 update_button):
     """Upload patient data and metrics to the server.
 
     This function takes the patient information and calculated
-    metrics and uploads them to the server. It first checks if
-    the MRN or room number already exists in the database and
-    prompts the user for confirmation if necessary. If the upload
-    is successful, the GUI elements are updated accordingly, and
-    the function returns True. If an error occurs during the upload,
-    an error message is displayed, and the function returns False.
+    metrics and uploads them to the server. The server refuses the
+    upload with 409 Conflict if the MRN or room number already
+    exists in the database; the user is then prompted for
+    confirmation and the upload is sent again with "force" set, so
+    that uploading a new patient only takes one request. If the upload
+    is successful, the GUI elements are updated accordingly. If an
+    error occurs during the upload, an error message is displayed.
+
+    The requests are sent from the worker thread, and the upload
+    button is disabled until the server has replied, so that the
+    same data cannot be uploaded twice.
 
     :param root: tk.Tk root window
     :param patient_info: dict containing patient information
@@ -157,25 +370,31 @@ def upload_data(root, patient_info, metrics, mrn_entry,
     :param room_number_entry: ttk.Entry for the room number input
     :param upload_button: ttk.Button for uploading data
     :param update_button: ttk.Button for updating data
-
-    :return: bool indicating whether the upload was successful
     """
-    url = f"http://{INSTANCEURL}/check_exists"
+    url = f"http://{INSTANCEURL}/upload_data"
     data = {
         "mrn": patient_info['mrn'].get(),
-        "room_number": patient_info['room_number'].get()
-    }
-    files = {
-            "data": ("data.json", json.dumps(data), "application/json"),
+        "datetime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "name": patient_info['name'].get(),
+        "currcpap": patient_info['cpap_pressure'].get(),
+        "br": str(metrics['breath_rate_bpm']),
+        "apnea": str(metrics['apnea_count']),
+        "room_number": patient_info['room_number'].get(),
+        "force": False
     }
 
-    try:
-        response = requests.post(url, files=files)
-        response.raise_for_status()
-        response_data = response.json()
+    def handle_reply(future):
+        # Allow another attempt unless the upload below succeeds
+        upload_button.config(state="normal")
+        try:
+            response = future.result()
+        except requests.exceptions.RequestException as e:
+            messagebox.showerror("Error", f"Network error: {str(e)}")
+            return
+        response_data = parse_json(response) or {}
 
-        if 'exists' in response_data:
-            field = response_data['exists']
+        if response.status_code == 409:
+            field = response_data['conflict']
             if field == 'mrn':
                 confirm_mrn = messagebox.askyesno(
                     "Confirmation",
@@ -186,7 +405,7 @@ def upload_data(root, patient_info, metrics, mrn_entry,
                 )
                 if not confirm_mrn:
                     messagebox.showinfo("Info", "Upload canceled.")
-                    return False
+                    return
             elif field == 'room':
                 confirm_room = messagebox.askyesno(
                     "Confirmation",
@@ -196,43 +415,30 @@ def upload_data(root, patient_info, metrics, mrn_entry,
                 )
                 if not confirm_room:
                     messagebox.showinfo("Info", "Upload canceled.")
-                    return False
+                    return
 
             # Check CPAP pressure only if MRN or room number exists
             if not check_cpap_pressure(root, patient_info):
-                return False
-        else:
-            # MRN and room number do not exist, skip CPAP pressure check
-            pass
-
-        # Perform the actual data upload
-        url = f"http://{INSTANCEURL}/upload_data"
-        data = {
-            "mrn": patient_info['mrn'].get(),
-            "datetime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "name": patient_info['name'].get(),
-            "currcpap": patient_info['cpap_pressure'].get(),
-            "br": str(metrics['breath_rate_bpm']),
-            "apnea": str(metrics['apnea_count']),
-            "room_number": patient_info['room_number'].get()
-        }
-        plot_data = io.BytesIO()
-        plt.savefig(plot_data, format='png')
-        plot_data.seek(0)
-        plot_bytes = plot_data.read()
-        files = {
-            "data": ("data.json", json.dumps(data), "application/json"),
-            "plot": ("plot.png", plot_bytes, "image/png")
-        }
-
-        response = requests.post(url, files=files)
-        response.raise_for_status()
-        response_data = response.json()
+                return
+
+            # Upload again, replacing the existing patient or room
+            data["currcpap"] = patient_info['cpap_pressure'].get()
+            data["force"] = True
+            upload_button.config(state="disabled")
+            post_in_background(root, patient_info, handle_reply, url, data,
+                               metrics['plot_bytes'])
+            return
+
+        if not response.ok:
+            error_message = response_data.get('error',
+                                              "Unknown error occurred")
+            messagebox.showerror("Upload Failed", error_message)
+            return
 
         if 'error' in response_data:
             error_message = response_data['error']
             messagebox.showerror("Error", error_message)
-            return False
+            return
 
         messagebox.showinfo("Success", "Data uploaded successfully.")
 
@@ -244,91 +450,87 @@ def upload_data(root, patient_info, metrics, mrn_entry,
         update_button.config(state="normal")
 
         periodic_cpap_update(root, patient_info)
-        return True
-    except requests.exceptions.HTTPError as e:
-        error_message = response.json().get('error', "Unknown error occurred")
-        messagebox.showerror("Upload Failed", error_message)
-    except requests.exceptions.RequestException as e:
-        messagebox.showerror("Error", f"Network error: {str(e)}")
+
+    upload_button.config(state="disabled")
+    post_in_background(root, patient_info, handle_reply, url, data,
+                       metrics['plot_bytes'])
 
 
-def update_data(root, patient_info, metrics):
+def update_data(root, patient_info, metrics, update_button):
     """Update patient data and metrics on the server.
 
     This function takes the patient information and calculated metrics
     and updates them on the server. It sends a request to the server
     with the updated data. If the update is successful, a success
-    message is displayed, and the function returns True. If an error
-    occurs during the update, an error message is displayed, and the
-    function returns False.
+    message is displayed. If an error occurs during the update, an
+    error message is displayed.
+
+    The request is sent from the worker thread, and the update button
+    is disabled until the server has replied.
 
     :param root: tk.Tk root window
     :param patient_info: dict containing patient information
     :param metrics: dict containing the calculated metrics
-
-    :return: bool indicating whether the update was successful
+    :param update_button: ttk.Button for updating data
     """
     try:
         room_number = patient_info['room_number'].get()
         mrn = patient_info['mrn'].get()
+        name = patient_info['name'].get()
         cpap_pressure = patient_info['cpap_pressure'].get()
     except tk.TclError as e:
         messagebox.showerror("Error",
                              ("Invalid input format. "
                               "Please enter valid values."))
-        return False
+        return
 
     url = f"http://{INSTANCEURL}/update_patient_info"
     data = {
         "mrn": str(mrn),
-        "name": patient_info['name'].get(),
+        "name": name,
         "currcpap": str(cpap_pressure),
         "br": str(metrics['breath_rate_bpm']),
         "apnea": str(metrics['apnea_count']),
         "mrn_locked": patient_info['mrn_locked'],
         "room_number_locked": patient_info['room_number_locked']
     }
-    plot_data = io.BytesIO()
-    plt.savefig(plot_data, format='png')
-    plot_data.seek(0)
-    plot_bytes = plot_data.read()
-    files = {
-        "data": ("data.json", json.dumps(data), "application/json"),
-        "plot": ("plot.png", plot_bytes, "image/png")
-    }
 
-    try:
-        response = requests.post(url, files=files)
-        response.raise_for_status()
-        try:
-            response_data = response.json()
-            messagebox.showinfo("Success",
-                                "Patient information updated "
-                                "successfully.")
-        except requests.exceptions.JSONDecodeError:
-            messagebox.showerror("Error", "Server encountered an error.")
-        return True
-    except requests.exceptions.HTTPError as e:
+    def handle_reply(future):
+        update_button.config(state="normal")
         try:
-            error_message = response.json().get('error',
-                                                ("Unknown error "
-                                                 "occurred"))
-        except requests.exceptions.JSONDecodeError:
+            response = future.result()
+        except requests.exceptions.RequestException as e:
+            messagebox.showerror("Error", ("Network Error: Server "
+                                           "is not online. Please "
+                                           "check the server connection."))
+            return
+        response_data = parse_json(response)
+        if response.ok:
+            if response_data is None:
+                messagebox.showerror("Error", "Server encountered an error.")
+            else:
+                messagebox.showinfo("Success",
+                                    "Patient information updated "
+                                    "successfully.")
+            return
+        if response_data is None:
             error_message = "Server encountered an error."
+        else:
+            error_message = response_data.get('error',
+                                              ("Unknown error "
+                                               "occurred"))
         messagebox.showerror("Update Failed", error_message)
-    except requests.exceptions.RequestException as e:
-        messagebox.showerror("Error", ("Network Error: Server "
-                                       "is not online. Please "
-                                       "check the server connection."))
-    return False
+
+    update_button.config(state="disabled")
+    post_in_background(root, patient_info, handle_reply, url, data,
+                       metrics['plot_bytes'])
 
 
 def patient_handler(root, patient_info, mrn_entry,
                     room_number_entry, upload_button,
                     update_button, file_selected_var,
                     file_name_label, breathing_rate_label,
-                    apnea_count_label, plot_label,
-                    file_selected_checkmark):
+                    apnea_count_label, plot_label):
     """Handle the patient data and file selection.
 
     This function is the main handler for patient data and file
@@ -336,7 +538,10 @@ def patient_handler(root, patient_info, mrn_entry,
     processes the data, and updates the GUI elements with the
     calculated metrics and plot. It also handles enabling and
     disabling the upload and update buttons based on the state
-    of the MRN and room number fields.
+    of the MRN and room number fields. The data is processed on
+    a worker thread, so that the GUI stays responsive during the
+    analysis; if another file is selected in the meantime, only
+    the results of the latest one are shown.
 
     :param root: tk.Tk root window
     :param patient_info: dict containing patient information
@@ -352,13 +557,15 @@ def patient_handler(root, patient_info, mrn_entry,
                                  rate
     :param apnea_count_label: ttk.Label to display the apnea count
     :param plot_label: ttk.Label to display the flow rate plot
-    :param file_selected_checkmark: ttk.Label to display the file
-                                    selection checkmark
     """
-    cpap_file_path = select_cpap_file()
-    if cpap_file_path:
-        metrics = process_cpap_data(cpap_file_path)
-        if metrics:
+    def show_results(future):
+        if patient_info.get('analysis') is not future:
+            return  # a newer file has been selected
+        del patient_info['analysis']
+        metrics = future.result()
+        if metrics is None:
+            show_processing_error()
+        else:
             if (not patient_info['mrn_locked'] and
                not patient_info['room_number_locked']):
                 upload_button.config(state="normal")
@@ -368,16 +575,23 @@ def patient_handler(root, patient_info, mrn_entry,
                 update_button.config(state="normal")
             patient_info['metrics'] = metrics
             file_selected_var.set(True)
-            file_selected_checkmark.config(text="✓", foreground="green")
             file_name = os.path.basename(cpap_file_path)
             file_name_label.config(text="File Selected: "+file_name)
             display_metrics(root, metrics, metrics['flow_rate'],
                             breathing_rate_label, apnea_count_label,
                             plot_label)
+
+    cpap_file_path = select_cpap_file(root)
+    if cpap_file_path:
+        future = analysis_executor.submit(process_cpap_data,
+                                          cpap_file_path, show_error=False)
+        patient_info['analysis'] = future
+        future.add_done_callback(
+            lambda future: run_on_tk_thread(root, show_results, future))
     else:
         logger.info("No CPAP data file selected.")
+        patient_info.pop('analysis', None)
         file_selected_var.set(False)
-        file_selected_checkmark.config(text="x", foreground="red")
         file_name_label.config(text="")
 
 
@@ -400,22 +614,19 @@ def check_cpap_pressure(root, patient_info):
         "mrn": patient_info['mrn'].get(),
         "room_number": patient_info['room_number'].get()
     }
-    files = {
-            "data": ("data.json", json.dumps(data), "application/json"),
-    }
+    entered_cpap_pressure = patient_info['cpap_pressure'].get()
     try:
-        response = requests.post(url, files=files)
-        response.raise_for_status()
-        response_data = response.json()
+        response = post_data(url, data)
+        response_data = parse_json(response) or {}
 
-        if 'error' in response_data:
-            error_message = response_data['error']
+        if 'error' in response_data or not response.ok:
+            error_message = response_data.get(
+                'error', f"Server error: {response.status_code}")
             messagebox.showerror("Error", error_message)
             return False
 
         if 'cpap_pressure' in response_data:
             db_cpap_pressure = float(response_data['cpap_pressure'])
-            entered_cpap_pressure = patient_info['cpap_pressure'].get()
 
             if not entered_cpap_pressure:
                 # If entered CPAP pressure is an empty string => database value
@@ -454,9 +665,21 @@ def periodic_cpap_update(root, patient_info):
     update their local value. If the user confirms, the CPAP pressure
     entry is updated with the new value received from the server.
 
+    The request is sent from the worker thread so that the GUI stays
+    responsive while waiting for the server; the response is handled
+    by handle_cpap_update on the Tk thread, which schedules the next
+    check. The ETag of the last reply the user has acted on is sent
+    along, so that an unchanged CPAP pressure is answered with an
+    empty 304 Not Modified.
+
+    Only one check is ever pending: a check that is already scheduled
+    or waiting for the server is superseded by a new call, so that
+    repeated uploads do not start more loops.
+
     :param root: tk.Tk root window
     :param patient_info: dict containing patient information
     """
+    cancel_cpap_update(root, patient_info)
     if patient_info['mrn_locked'] and patient_info['room_number_locked']:
         url = f"http://{INSTANCEURL}/fetch_cpap_pressure"
         data = {
@@ -464,43 +687,110 @@ def periodic_cpap_update(root, patient_info):
             "room_number": patient_info['room_number'].get(),
             "currcpap": patient_info['cpap_pressure'].get(),
         }
-        files = {
-                "data": ("data.json", json.dumps(data), "application/json"),
-        }
-        try:
-            response = requests.post(url, files=files)
-            response.raise_for_status()
-            response_data = response.json()
-
-            if 'error' in response_data:
-                error_message = response_data['error']
-                messagebox.showerror("Error", error_message)
-            elif 'cpap_pressure' in response_data:
-                db_cpap_pressure = float(response_data['cpap_pressure'])
-                entered_cpap_pressure = float(
-                    patient_info['cpap_pressure'].get())
+        # Only ask for a 304 while the local value is still the one the
+        # ETag was stored with
+        etag, cpap_pressure = patient_info.get('cpap_etag', (None, None))
+        headers = ({"If-None-Match": etag}
+                   if etag and cpap_pressure == data["currcpap"] else {})
+        future = executor.submit(post_data, url, data, headers=headers)
+        patient_info['cpap_check'] = future
+        future.add_done_callback(
+            lambda future: run_on_tk_thread(root, handle_cpap_update, root,
+                                            patient_info, future))
+    else:
+        schedule_cpap_update(root, patient_info)
 
-                if entered_cpap_pressure != db_cpap_pressure:
-                    confirm = messagebox.askyesno(
-                        "CPAP Pressure Update",
-                        ("The monitoring station has set a new CPAP "
-                         "pressure ({}). Do you want "
-                         "to update to the monitoring station's CPAP "
-                         "pressure?".format(db_cpap_pressure))
-                    )
-                    if confirm:
-                        patient_info['cpap_pressure'].set(
-                            str(db_cpap_pressure))
-        except requests.exceptions.RequestException as e:
-            messagebox.showerror("Error", f"Network error: {str(e)}")
 
-    root.after(15000, periodic_cpap_update, root, patient_info)
+def schedule_cpap_update(root, patient_info):
+    """Schedule the next periodic CPAP pressure check in 15 seconds.
+
+    The id of the scheduled call is kept in patient_info, so that
+    cancel_cpap_update can cancel it.
+
+    :param root: tk.Tk root window
+    :param patient_info: dict containing patient information
+    """
+    patient_info['cpap_update_id'] = root.after(15000, periodic_cpap_update,
+                                                root, patient_info)
+
+
+def cancel_cpap_update(root, patient_info):
+    """Stop the periodic CPAP pressure check.
+
+    This function cancels the scheduled check, if any, and makes
+    handle_cpap_update ignore the reply to a check that is still
+    waiting for the server.
+
+    :param root: tk.Tk root window
+    :param patient_info: dict containing patient information
+    """
+    after_id = patient_info.pop('cpap_update_id', None)
+    if after_id is not None:
+        root.after_cancel(after_id)
+    patient_info.pop('cpap_check', None)
+
+
+def handle_cpap_update(root, patient_info, future):
+    """Handle the server's reply to a periodic CPAP pressure check.
+
+    This function runs on the Tk thread once the request sent by
+    periodic_cpap_update has completed. If the monitoring station
+    has set a CPAP pressure different from the local value, the user
+    is asked whether to use it. The next check is only scheduled
+    after any dialog has been closed, so that checks cannot pile up
+    behind an open dialog. A 304 Not Modified reply means that the
+    CPAP pressure is unchanged and is ignored.
+
+    :param root: tk.Tk root window
+    :param patient_info: dict containing patient information
+    :param future: concurrent.futures.Future holding the response
+                   of the request
+    """
+    if patient_info.get('cpap_check') is not future:
+        return  # the check was cancelled or superseded
+    del patient_info['cpap_check']
+    try:
+        response = future.result()
+        if response.status_code == 304:
+            # The CPAP pressure has not changed since the last check
+            response_data = {}
+        else:
+            response_data = parse_json(response) or {}
+
+        if 'error' in response_data or not response.ok:
+            error_message = response_data.get(
+                'error', f"Server error: {response.status_code}")
+            messagebox.showerror("Error", error_message)
+        elif 'cpap_pressure' in response_data:
+            db_cpap_pressure = float(response_data['cpap_pressure'])
+            entered_cpap_pressure = patient_info['cpap_pressure'].get()
+
+            if float(entered_cpap_pressure) != db_cpap_pressure:
+                confirm = messagebox.askyesno(
+                    "CPAP Pressure Update",
+                    ("The monitoring station has set a new CPAP "
+                     "pressure ({}). Do you want "
+                     "to update to the monitoring station's CPAP "
+                     "pressure?".format(db_cpap_pressure))
+                )
+                if confirm:
+                    entered_cpap_pressure = str(db_cpap_pressure)
+                    patient_info['cpap_pressure'].set(entered_cpap_pressure)
+            if float(entered_cpap_pressure) == db_cpap_pressure:
+                # Only skip this reply from now on if the local value
+                # matches it, so that a declined update is asked again
+                patient_info['cpap_etag'] = (response.headers.get("ETag"),
+                                             entered_cpap_pressure)
+    except requests.exceptions.RequestException as e:
+        messagebox.showerror("Error", f"Network error: {str(e)}")
+
+    schedule_cpap_update(root, patient_info)
 
 
 def reset_fields(root, patient_info, mrn_entry, room_number_entry,
                  upload_button, update_button, file_selected_var,
                  file_name_label, breathing_rate_label, apnea_count_label,
-                 plot_label, file_selected_checkmark):
+                 plot_label):
     """Reset all input fields and clear the displayed metrics and plot.
 
     This function resets all the input fields to their default values
@@ -521,8 +811,6 @@ def reset_fields(root, patient_info, mrn_entry, room_number_entry,
     :param breathing_rate_label: ttk.Label to display the breathing rate
     :param apnea_count_label: ttk.Label to display the apnea count
     :param plot_label: ttk.Label to display the flow rate plot
-    :param file_selected_checkmark: ttk.Label to display the file
-                                    selection checkmark
     """
     patient_info['name'].set("")
     patient_info['mrn'].set("0")
@@ -536,29 +824,36 @@ def reset_fields(root, patient_info, mrn_entry, room_number_entry,
     update_button.config(state="disabled")
     file_selected_var.set(False)
     file_name_label.config(text="")
-    file_selected_checkmark.config(text="x", foreground="red")
 
     # Clear the breathing rate, apnea count, and plot
     breathing_rate_label.config(text="")
     apnea_count_label.config(text="")
     plot_label.config(image="")
+    # The plot encoded for upload belongs to the cleared file
+    patient_info.pop('metrics', None)
+    patient_info.pop('cpap_etag', None)
+    patient_info.pop('analysis', None)
+    patient_info.pop('request', None)
 
-    root.after_cancel(root.after_id)  # Cancel the periodic CPAP update
+    cancel_cpap_update(root, patient_info)
 
 
-def on_closing(root):
+def on_closing(root, patient_info):
     """Handles the window close event.
 
     This function is called when the user attempts to close the
     main window. It displays a confirmation dialog asking the
     user if they really want to quit. If the user confirms, the
-    periodic CPAP update is canceled, and the main window is
-    destroyed, effectively closing the application.
+    periodic CPAP update and any analysis still running are
+    canceled, and the main window is destroyed, effectively closing
+    the application.
 
     :param root: tk.Tk root window
+    :param patient_info: dict containing patient information
     """
     if messagebox.askyesno("Quit", "Do you really want to quit?"):
-        root.after_cancel(root.after_id)  # Cancel the pending after call
+        cancel_cpap_update(root, patient_info)
+        patient_info.pop('analysis', None)
         root.destroy()
         root.quit()  # Exit the Tkinter event loop
 
@@ -657,13 +952,16 @@ def main():
                                         upload_button, update_button,
                                         file_selected_var, file_name_label,
                                         breathing_rate_label,
-                                        apnea_count_label, plot_label,
-                                        file_selected_checkmark)
+                                        apnea_count_label, plot_label)
     )
     select_file_button.pack(side=tk.LEFT)
 
-    file_selected_checkmark = ttk.Label(select_file_button_frame, text="✓",
-                                        foreground="green")
+    checkmark_var = tk.StringVar()
+    style = ttk.Style(root)
+    style.configure("Checked.TLabel", foreground="green")
+    style.configure("Unchecked.TLabel", foreground="red")
+    file_selected_checkmark = ttk.Label(select_file_button_frame,
+                                        textvariable=checkmark_var)
     file_selected_checkmark.pack(side=tk.LEFT, padx=5)
 
     upload_button = ttk.Button(
@@ -681,59 +979,89 @@ def main():
         root,
         text="Update Data",
         command=lambda: update_data(root, patient_info,
-                                    patient_info['metrics']),
+                                    patient_info['metrics'], update_button),
         state="disabled"
     )
     update_button.grid(row=9, column=1, padx=5, pady=5)
 
-    def update_checkmark():
+    checkmark_pending = False
+    # File selection status currently painted, kept on the Python side
+    checkmark_selected = None
+
+    def update_checkmark(*_):
+        """Schedule an update of the file selection checkmark.
+
+        The function is registered as a write trace on file_selected_var,
+        so the checkmark is only updated when the file selection status
+        changes, instead of polling it. The label is repainted from the
+        idle queue rather than inside the code that set the variable,
+        and several changes before the next idle time only repaint it
+        once.
+        """
+        nonlocal checkmark_pending
+        if not checkmark_pending:
+            checkmark_pending = True
+            root.after_idle(paint_checkmark)
+
+    def paint_checkmark():
         """Update the file selection checkmark based on the file selection
            status.
 
-        This function periodically checks the status of the file selection
-        and updates the file selection checkmark accordingly. If a file is
-        selected, the checkmark is set to a green checkmark symbol (✓). If
-        no file is selected, the checkmark is set to a red cross symbol (x).
-
-        The function uses the after method to schedule itself to be called
-        repeatedly every 100 milliseconds. This allows the checkmark to be
-        updated in real-time based on the file selection status.
+        This function updates the file selection checkmark according to
+        the file selection status. If a file is selected, the checkmark
+        is set to a green checkmark symbol (✓). If no file is selected,
+        the checkmark is set to a red cross symbol (x). The label shows
+        checkmark_var, and it is only touched when the status differs
+        from the one painted last.
 
-        The function also checks if the root window still exists before
-        updating the checkmark. This is to avoid potential errors that may
-        occur if the window is closed while the function is still scheduled
-        to be called.
+        If the window has been closed before the repaint runs, Tk
+        raises a TclError and nothing is painted.
         """
-        if root.winfo_exists():
-            if file_selected_var.get():
-                file_selected_checkmark.config(text="✓", foreground="green")
-            else:
-                file_selected_checkmark.config(text="x", foreground="red")
-            # avoiding error when closing:
-            root.after_id = root.after(100, update_checkmark)
+        nonlocal checkmark_pending, checkmark_selected
+        checkmark_pending = False
+        try:
+            selected = file_selected_var.get()
+            if selected != checkmark_selected:
+                checkmark_var.set("✓" if selected else "x")
+                file_selected_checkmark.config(
+                    style="Checked.TLabel" if selected
+                    else "Unchecked.TLabel")
+                checkmark_selected = selected
+        except tk.TclError:
+            return  # the window has been closed
 
     reset_button = ttk.Button(
         root,
         text="Reset",
-        command=lambda: reset_fields(root, patient_info, mrn_entry,
-                                     room_number_entry, upload_button,
-                                     update_button, file_selected_var,
-                                     file_name_label, breathing_rate_label,
-                                     apnea_count_label, plot_label,
-                                     file_selected_checkmark)
+        command=partial(reset_fields, root, patient_info, mrn_entry,
+                        room_number_entry, upload_button,
+                        update_button, file_selected_var,
+                        file_name_label, breathing_rate_label,
+                        apnea_count_label, plot_label)
     )
     reset_button.grid(row=10, column=0, padx=5, pady=5)
 
     close_button = ttk.Button(root, text="Close",
-                              command=lambda: on_closing(root))
+                              command=partial(on_closing, root, patient_info))
     close_button.grid(row=10, column=1, padx=5, pady=5)
 
-    root.after_id = root.after(100, update_checkmark)
+    file_selected_var.trace_add("write", update_checkmark)
+    paint_checkmark()
     root.mainloop()
 
+    # Do not wait for a check or analysis still running
+    executor.shutdown(wait=False)
+    analysis_executor.shutdown(wait=False)
+    session.close()
+
 
 if __name__ == "__main__":
-    INSTANCEURL = input('write your url\n')
+    # The server address can be given as an argument, to start the GUI
+    # without waiting for the prompt
+    if len(sys.argv) > 1:
+        INSTANCEURL = sys.argv[1]
+    else:
+        INSTANCEURL = input('write your url\n')
     if len(INSTANCEURL) < 3:
         INSTANCEURL = "localhost:5001"
     main()
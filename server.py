@@ -1,10 +1,73 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from google.cloud.sql.connector import Connector
 import base64
 import json
+import logging
+import queue
+import threading
+import time
 import pytds
 
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to jsonify
+    orjson = None
+
+try:
+    import pybase64
+except ImportError:  # pybase64 is optional, fall back to base64
+    pybase64 = None
+
+logger = logging.getLogger(__name__)
+
+# Cloud SQL connector shared by all database connections, created on
+# the first connection so that it only authenticates once, and in the
+# process that serves the requests rather than before any fork
+connector = None
+connector_lock = threading.Lock()
+
+# Number of open database connections kept for reuse by get_cursor
+pool_size = 10
+# Open connections that no request is using at the moment, as
+# (connection, time it was returned) tuples
+idle_connections = queue.LifoQueue(maxsize=pool_size)
+# Seconds after which an idle connection is closed instead of reused,
+# below the 30 minutes after which Cloud SQL may drop it
+connection_max_idle = 25 * 60
+
+# Operational range of the CPAP pressure in cmH2O
+min_cpap_pressure = 4.0
+max_cpap_pressure = 25.0
+# Error returned for a CPAP pressure that validate_cpap_pressure rejects
+invalid_cpap_error = {"error": ("Invalid CPAP pressure: "
+                                "CPAP pressure out of range "
+                                "(4-25 cmH\u2082O) and/or must "
+                                "be a float")}
+
+# Results of the polled read queries, kept for read_cache_ttl seconds
+# as (time stored, result) under keys chosen by cached_query, and
+# cleared by every request that writes to the now table
+read_cache = {}
+read_cache_ttl = 5
+read_cache_size = 2048
+
+# Base64-encoded plots of the entries table by (MRN, datetime), least
+# recently used first. Entries are never changed once written, so the
+# plots are kept until they make up more than plot_cache_bytes
+plot_cache = OrderedDict()
+plot_cache_bytes = 50 * 1024 * 1024
+plot_cache_lock = threading.Lock()
+
+# Keys of the JSON payload accepted by validate_send_cpap, in any order
+send_cpap_keys = frozenset(("room_number", "cpap"))
+
+# Characters allowed in a patient name by validate_name
+allowed_name_chars = frozenset("abcdefghijklmnopqrstuvwxyz"
+                               "ABCDEFGHIJKLMNOPQRSTUVWXYZ '-")
+
 
 def convert_file_to_base64_str(filename):
     """Convert a file to a base64-encoded string.
@@ -25,6 +88,28 @@ def convert_file_to_base64_str(filename):
     return b64_string
 
 
+def plot_to_base64_str(plot):
+    """Convert a plot read from the database to a base64 string.
+
+    Plots are stored as raw image bytes in the VARBINARY plot
+    columns, while the monitoring station receives them as base64
+    strings inside its JSON responses. If the pybase64 package is
+    installed, its SIMD encoder is used, which returns the str
+    directly. Otherwise, since base64 only uses ASCII characters,
+    the bytes from the base64 module are decoded as ASCII.
+
+    :param plot: bytes containing the plot image, or None if the
+                 entry has no plot
+    :return: str containing the base64-encoded plot, or None if the
+             entry has no plot
+    """
+    if plot is None:
+        return None
+    if pybase64 is not None:
+        return pybase64.b64encode_as_string(plot)
+    return base64.b64encode(plot).decode('ascii')
+
+
 def connect_to_db():
     """Connect to the SQL Server database.
 
@@ -36,11 +121,16 @@ def connect_to_db():
     :return: pymssql.Connection object representing the database
              connection
     """
+    global connector
     project_id = 'the-dock-420320'
     region = 'us-east1'
     instance_name = 'cpap'
     INSTANCE_CONNECTION_NAME = f"{project_id}:{region}:{instance_name}"
-    connector = Connector()
+    with connector_lock:
+        if connector is None:
+            # Refresh the instance certificate when connecting instead
+            # of on a background timer, which does not survive a fork
+            connector = Connector(refresh_strategy="lazy")
     conn = connector.connect(
         INSTANCE_CONNECTION_NAME,
         "pytds",
@@ -50,10 +140,65 @@ def connect_to_db():
         db='patients',
         autocommit=True
     )
-    print("connection successful")
+    logger.info("connection successful")
     return conn
 
 
+@contextmanager
+def get_cursor():
+    """Provide a database cursor for the duration of a request.
+
+    This function takes an idle connection from the pool, or opens a
+    new one with connect_to_db if none is idle, and yields a cursor
+    on it. Since Flask serves requests on several threads, every
+    request gets a connection of its own instead of sharing one
+    cursor. When the request is done, the connection is put back
+    into the pool. It is closed instead if the request raised, as it
+    may have been broken, or if the pool already holds pool_size
+    idle connections. Connections that have been idle for
+    connection_max_idle seconds are closed rather than handed out,
+    since the database may have dropped them in the meantime.
+
+    :return: pymssql.Cursor object representing the database cursor
+    """
+    conn = None
+    while conn is None:
+        try:
+            conn, returned = idle_connections.get_nowait()
+        except queue.Empty:
+            conn = connect_to_db()
+            break
+        if time.monotonic() - returned > connection_max_idle:
+            conn.close()
+            conn = None
+    cursor = conn.cursor()
+    try:
+        yield cursor
+    except BaseException:
+        cursor.close()
+        conn.close()
+        raise
+    cursor.close()
+    try:
+        idle_connections.put_nowait((conn, time.monotonic()))
+    except queue.Full:
+        conn.close()
+
+
+def prewarm_pool(count=pool_size):
+    """Open database connections for the first requests in advance.
+
+    This function opens the given number of connections with
+    connect_to_db and puts them into the pool used by get_cursor, so
+    that the first requests after the server starts do not wait for
+    the Cloud SQL handshake.
+
+    :param count: int containing the number of connections to open
+    """
+    while idle_connections.qsize() < count:
+        idle_connections.put_nowait((connect_to_db(), time.monotonic()))
+
+
 def validate_name(name):
     """Validate a patient name.
 
@@ -70,11 +215,8 @@ def validate_name(name):
     """
     if name:
         name = name.strip()
-        allowed_chars = ("abcdefghijklmnopqrstuvwxyz"
-                         "ABCDEFGHIJKLMNOPQRSTUVWXYZ '-")
-        for char in name:
-            if char not in allowed_chars:
-                return ""  # Invalid char returns empty string
+        if not allowed_name_chars.issuperset(name):
+            return ""  # Invalid char returns empty string
         return name
     return ""
 
@@ -136,7 +278,7 @@ def validate_cpap_pressure(cpap_pressure):
     """
     try:
         pressure = float(cpap_pressure)
-        if 4 <= pressure <= 25:
+        if min_cpap_pressure <= pressure <= max_cpap_pressure:
             return pressure
     except (ValueError, TypeError):
         return None
@@ -211,6 +353,85 @@ def execute_function(func, *args, **kwargs):
     return func(*args, **kwargs)
 
 
+def cached_query(key, func, *args):
+    """Execute a read query, reusing its result for a few seconds.
+
+    This function returns the result stored in read_cache under the
+    given key if it is less than read_cache_ttl seconds old, and
+    otherwise executes the function with the provided arguments and
+    stores its result. The monitoring stations poll the same rooms
+    every few seconds, so most polls are answered without a round trip
+    to the database. Writes to the now table clear the cache, so a
+    change made through this server is seen by the next poll. The
+    cache is emptied when it holds read_cache_size results, since its
+    keys come from the request payloads.
+
+    :param key: hashable object identifying the query and its
+                arguments
+    :param func: function object executing the query
+    :param *args: variable-length positional arguments to pass to the
+                  function
+
+    :return: the stored or newly queried result of the function
+    """
+    now = time.monotonic()
+    entry = read_cache.get(key)
+    if entry is not None and now - entry[0] < read_cache_ttl:
+        return entry[1]
+    result = func(*args)
+    if len(read_cache) >= read_cache_size:
+        read_cache.clear()
+    read_cache[key] = (now, result)
+    return result
+
+
+def json_response(data):
+    """Create a JSON response for the data of a read request.
+
+    If the orjson package is installed, it is used to serialize the
+    data, which is faster than jsonify on the long base64 plot
+    strings and lists polled by the monitoring station. Datetimes and
+    decimals are still converted by Flask's default function, so the
+    response is the same as with jsonify.
+
+    :param data: object containing the data to send as JSON
+
+    :return: Flask response object containing the data as JSON
+    """
+    if orjson is None:
+        return jsonify(data)
+    return Response(orjson.dumps(data, default=app.json.default,
+                                 option=orjson.OPT_PASSTHROUGH_DATETIME),
+                    mimetype="application/json")
+
+
+def conditional_response(response):
+    """Answer a polled request with 304 Not Modified if the data is
+    unchanged.
+
+    This function tags the response with an ETag computed from its
+    body. If the client sent the same ETag in its If-None-Match
+    header, nothing has changed since its last poll and an empty
+    304 Not Modified response is returned instead, so that the
+    client can skip parsing and redrawing the same data. Error
+    responses, given as a (response, status code) tuple, are
+    returned unchanged.
+
+    :param response: Flask response object containing the full
+                     JSON response
+
+    :return: the original response with an ETag header, or an empty
+             304 response if the client already has this data
+    """
+    if isinstance(response, tuple):
+        return response
+    response.add_etag()
+    etag, _ = response.get_etag()
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": response.headers["ETag"]})
+    return response
+
+
 app = Flask(__name__)
 
 
@@ -221,12 +442,16 @@ def execute_fetch_room_numbers():
     This is a Flask route handler that executes the
     fetch_room_numbers function when a GET request is
     made to the '/fetch_room_numbers' endpoint. It passes
-    the database cursor as an argument to the function.
+    the database cursor as an argument to the function. Since
+    the monitoring station polls this endpoint, an unchanged list
+    of rooms is answered with 304 Not Modified.
 
     :return: the result of executing the fetch_room_numbers
              function
     """
-    return execute_function(fetch_room_numbers, cursor)
+    with get_cursor() as cursor:
+        return conditional_response(execute_function(fetch_room_numbers,
+                                                     cursor))
 
 
 def fetch_room_numbers(cursor):
@@ -243,10 +468,26 @@ def fetch_room_numbers(cursor):
     :return: Flask response object containing the occupied
              room numbers as JSON
     """
+    return json_response(cached_query(("rooms",), query_room_numbers,
+                                      cursor))
+
+
+def query_room_numbers(cursor):
+    """Query the occupied room numbers.
+
+    This function executes the SELECT query behind
+    fetch_room_numbers and returns the room numbers themselves, so
+    that they can be kept by cached_query.
+
+    :param cursor: pymssql.Cursor object representing the
+                   database cursor
+
+    :return: list containing the occupied room numbers
+    """
     query = "SELECT room_number FROM now"
     cursor.execute(query)
     rooms = cursor.fetchall()
-    return jsonify([room[0] for room in rooms])
+    return [room[0] for room in rooms]
 
 
 @app.route('/fetch_cpap_calculated_data', methods=["POST"])
@@ -263,7 +504,8 @@ def fetch_cpap_calculated_data_handler():
     """
     in_json = request.get_json()
     room_number = in_json["room_number"]
-    return fetch_cpap_calculated_data(cursor, room_number)
+    with get_cursor() as cursor:
+        return fetch_cpap_calculated_data(cursor, room_number)
 
 
 def fetch_cpap_calculated_data(cursor, room_number):
@@ -282,12 +524,109 @@ def fetch_cpap_calculated_data(cursor, room_number):
     :return: Flask response object containing the CPAP calculated
              data as JSON
     """
-    query = (f"SELECT mrn, name, datetime, currcpap, br, apnea, plot "
-             f"FROM now WHERE room_number = '{room_number}'")
-    cursor.execute(query)
-    calculated_data = cursor.fetchall()
+    return json_response(cached_query(("calculated", room_number),
+                                      query_cpap_calculated_data, cursor,
+                                      room_number))
+
+
+def query_cpap_calculated_data(cursor, room_number):
+    """Query the CPAP calculated data for a given room number.
+
+    This function executes the SELECT query behind
+    fetch_cpap_calculated_data and returns the row itself, so
+    that it can also be combined with other data in a single
+    response.
+
+    :param cursor: pymssql.Cursor object representing the database
+                   cursor
+    :param room_number: int containing the room number to fetch data
+                        for
+
+    :return: list containing the MRN, name, datetime, CPAP
+             pressure, breathing rate, apnea count and base64-encoded
+             plot
+    """
+    query = ("SELECT mrn, name, datetime, currcpap, br, apnea, plot "
+             "FROM now WHERE room_number = %s")
+    cursor.execute(query, (room_number,))
+    calculated_data = list(cursor.fetchall()[0])
     """decimals are returned as strings"""
-    return jsonify(calculated_data[0])
+    calculated_data[6] = plot_to_base64_str(calculated_data[6])
+    return calculated_data
+
+
+@app.route('/fetch_patient_snapshot', methods=["POST"])
+def fetch_patient_snapshot_handler():
+    """Handle the request to fetch a snapshot of a room's patient.
+
+    This is a Flask route handler that handles a POST request
+    to the '/fetch_patient_snapshot' endpoint. It extracts the
+    room number from the JSON payload and passes it to the
+    fetch_patient_snapshot function.
+
+    :return: the result of executing the fetch_patient_snapshot
+             function
+    """
+    in_json = request.get_json()
+    room_number = in_json["room_number"]
+    with get_cursor() as cursor:
+        return fetch_patient_snapshot(cursor, room_number)
+
+
+def fetch_patient_snapshot(cursor, room_number):
+    """Fetch the CPAP calculated data and datetimes for a room.
+
+    This function combines the results of
+    fetch_cpap_calculated_data and fetch_datetimes_for_patient
+    for the patient in the given room, so that the monitoring
+    station gets everything it shows for a newly selected room
+    in one request. The snapshot is kept by cached_query like the
+    other polled reads.
+
+    :param cursor: pymssql.Cursor object representing the database
+                   cursor
+    :param room_number: int containing the room number to fetch data
+                        for
+
+    :return: Flask response object containing the CPAP calculated
+             data under "metrics" and the patient's datetimes under
+             "datetimes" as JSON
+    """
+    return json_response(cached_query(("snapshot", room_number),
+                                      query_patient_snapshot, cursor,
+                                      room_number))
+
+
+def query_patient_snapshot(cursor, room_number):
+    """Query the CPAP calculated data and datetimes for a room.
+
+    This function runs the SELECT queries of
+    query_cpap_calculated_data and query_datetimes_for_patient as
+    one batch, looking the patient's MRN up in the now table within
+    the batch, so that the snapshot takes a single round trip to the
+    database. The two result sets are read one after the other.
+
+    :param cursor: pymssql.Cursor object representing the database
+                   cursor
+    :param room_number: int containing the room number to fetch data
+                        for
+
+    :return: dict containing the CPAP calculated data under
+             "metrics" and the patient's datetimes under "datetimes"
+    """
+    query = """
+        SELECT mrn, name, datetime, currcpap, br, apnea, plot
+        FROM now WHERE room_number = %(room_number)s;
+
+        SELECT datetime FROM entries WHERE mrn =
+        (SELECT TOP 1 mrn FROM now WHERE room_number = %(room_number)s)
+    """
+    cursor.execute(query, {"room_number": room_number})
+    calculated_data = list(cursor.fetchall()[0])
+    calculated_data[6] = plot_to_base64_str(calculated_data[6])
+    cursor.nextset()
+    datetimes = [dt[0] for dt in cursor.fetchall()]
+    return {"metrics": calculated_data, "datetimes": datetimes}
 
 
 @app.route('/check_exists', methods=["POST"])
@@ -301,15 +640,16 @@ def check_exists_handler():
 
     :return: the result of executing the check_exists function
     """
-    return execute_function(check_exists, cursor, request.files)
+    with get_cursor() as cursor:
+        return execute_function(check_exists, cursor, request.files)
 
 
 def check_exists(cursor, request):
     """Check if the MRN or room number already exists in the database.
 
     This function checks if the provided MRN or room number already
-    exists in the 'now' table of the database. It executes SELECT
-    COUNT queries to check the existence and returns the result as a
+    exists in the 'now' table of the database. It executes a SELECT
+    COUNT query to check the existence and returns the result as a
     JSON response.
 
     :param cursor: pymssql.Cursor object representing the database
@@ -331,27 +671,42 @@ def check_exists(cursor, request):
                                   "room number must be an integer")}), 420
 
     try:
-        # Check if the MRN already exists in the now table
-        query = "SELECT COUNT(*) FROM now WHERE mrn = %s"
-        cursor.execute(query, (mrn,))
-        mrn_count = cursor.fetchone()[0]
-
-        # Check if the room number already exists in the now table
-        query = "SELECT COUNT(*) FROM now WHERE room_number = %s"
-        cursor.execute(query, (room_number,))
-        room_count = cursor.fetchone()[0]
-
-        exists_info = {}
-        if mrn_count > 0:
-            exists_info["exists"] = "mrn"
-        if room_count > 0:
-            exists_info["exists"] = "room"
-
-        return jsonify(exists_info)
+        return jsonify(find_existing(cursor, mrn, room_number))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+def find_existing(cursor, mrn, room_number):
+    """Find out whether an MRN or room number is already in use.
+
+    This function executes the SELECT COUNT query behind
+    check_exists. It is also used by upload_data, so that an
+    upload can be checked without a separate request.
+
+    :param cursor: pymssql.Cursor object representing the database
+                   cursor
+    :param mrn: int containing the validated MRN
+    :param room_number: int containing the validated room number
+
+    :return: dict with the key "exists" set to "mrn" or "room" if
+             either is already in the now table, or an empty dict
+    """
+    # Count the rows of the now table with the MRN and with the room
+    # number in a single round trip
+    query = ("SELECT COUNT(CASE WHEN mrn = %s THEN 1 END), "
+             "COUNT(CASE WHEN room_number = %s THEN 1 END) "
+             "FROM now WHERE mrn = %s OR room_number = %s")
+    cursor.execute(query, (mrn, room_number, mrn, room_number))
+    mrn_count, room_count = cursor.fetchone()
+
+    exists_info = {}
+    if mrn_count > 0:
+        exists_info["exists"] = "mrn"
+    if room_count > 0:
+        exists_info["exists"] = "room"
+    return exists_info
+
+
 @app.route('/fetch_cpap_pressure', methods=["POST"])
 def fetch_cpap_pressure_handler():
     """Handle the request to fetch CPAP pressure.
@@ -360,12 +715,16 @@ def fetch_cpap_pressure_handler():
     request to the '/fetch_cpap_pressure' endpoint. It
     extracts the MRN, room number, and current CPAP pressure
     from the JSON payload and passes them to the
-    fetch_cpap_pressure function.
+    fetch_cpap_pressure function. Since the patient GUI polls this
+    endpoint, an unchanged CPAP pressure is answered with 304 Not
+    Modified.
 
     :return: the result of executing the fetch_cpap_pressure
              function
     """
-    return execute_function(fetch_cpap_pressure, cursor, request.files)
+    with get_cursor() as cursor:
+        return conditional_response(execute_function(fetch_cpap_pressure,
+                                                     cursor, request.files))
 
 
 def fetch_cpap_pressure(cursor, request):
@@ -390,33 +749,27 @@ def fetch_cpap_pressure(cursor, request):
 
     try:
         query = ("SELECT currcpap FROM now WHERE "
-                 "mrn = {} OR room_number = {}".format(mrn, room_number))
-        cursor.execute(query)
+                 "mrn = %s OR room_number = %s")
+        cursor.execute(query, (mrn, room_number))
         result = cursor.fetchone()
 
         if result:
             cpap_pressure = result[0]
             # Validate the CPAP pressure format
             if validate_cpap_pressure(cpap_pressure) is None:
-                return jsonify({"error": ("Invalid CPAP pressure: "
-                                          "CPAP pressure out of range "
-                                          "(4-25 cmH\u2082O) and/or must "
-                                          "be a float")}), 416
+                return jsonify(invalid_cpap_error), 416
             else:
                 return jsonify({'cpap_pressure': cpap_pressure})
         else:
             if currcpap is not None:
                 if validate_cpap_pressure(currcpap) is None:
-                    return jsonify({"error": ("Invalid CPAP pressure: "
-                                              "CPAP pressure out of range "
-                                              "(4-25 cmH\u2082O) and/or must "
-                                              "be a float")}), 416
+                    return jsonify(invalid_cpap_error), 416
                 else:
                     return jsonify({'cpap_pressure': currcpap})
             else:
                 return jsonify({'cpap_pressure': "0.0"})
     except Exception as e:
-        print(f"Error occurred while fetching CPAP pressure: {str(e)}")
+        logger.error("Error occurred while fetching CPAP pressure: %s", e)
         return jsonify({"error": "An error occurred"}), 500
         return jsonify({"error": "An error occurred"}), 500
 
@@ -432,7 +785,8 @@ def execute_upload_data():
 
     :return: the result of executing the upload_data function
     """
-    return execute_function(upload_data, cursor, request.files)
+    with get_cursor() as cursor:
+        return execute_function(upload_data, cursor, request.files)
 
 
 def upload_data(cursor, request):
@@ -444,6 +798,11 @@ def upload_data(cursor, request):
     existing row or inserts a new row in the 'now' table based
     on the MRN or room number.
 
+    Unless the data has "force" set to true, an upload whose MRN or
+    room number already exists is refused with 409 Conflict and the
+    conflicting field, so that the client can ask the user before
+    replacing the existing patient and send the upload again.
+
     :param cursor: pymssql.Cursor object representing the database
                    cursor
     :param request: Flask request object containing the data and
@@ -470,10 +829,7 @@ def upload_data(cursor, request):
                                   "empty or contain invalid "
                                   "characters")}), 415
     if currcpap is None:
-        return jsonify({"error": ("Invalid CPAP pressure: "
-                                  "CPAP pressure out of range "
-                                  "(4-25 cmH\u2082O) and/or must "
-                                  "be a float")}), 416
+        return jsonify(invalid_cpap_error), 416
     if br is None:
         return jsonify({"error": "Invalid breathing rate"}), 417
     if apnea is None:
@@ -485,34 +841,31 @@ def upload_data(cursor, request):
         return jsonify({"error": ("Invalid room number: "
                                   "room number must be an integer")}), 420
 
+    if not data.get('force'):
+        try:
+            exists_info = find_existing(cursor, mrn, room_number)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        if exists_info:
+            return jsonify({"conflict": exists_info["exists"]}), 409
+
     plot_bytes = plot_file.read()
-    plot_base64 = base64.b64encode(plot_bytes).decode('utf-8')
 
     try:
-        # Insert into entries table
+        # Insert into entries table, and update the existing row in the
+        # now table or insert a new row, in one batch. The parameters
+        # are named so that the plot is only sent to the database once
         query = """
             INSERT INTO entries (mrn, datetime,
             name, currcpap, br, apnea, plot, room_number)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        values = (
-            mrn,
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            name,
-            currcpap,
-            br,
-            apnea,
-            plot_base64,
-            room_number
-        )
-        cursor.execute(query, values)
+            VALUES (%(mrn)s, %(datetime)s, %(name)s, %(currcpap)s,
+            %(br)s, %(apnea)s, %(plot)s, %(room_number)s);
 
-        # Update the existing row in the now table or insert a new row
-        query = """
             MERGE INTO now AS target
-            USING (SELECT %s AS mrn, %s AS name, %s AS datetime,
-                   %s AS currcpap, %s AS br, %s AS apnea, %s AS plot,
-                   %s AS room_number) AS source
+            USING (SELECT %(mrn)s AS mrn, %(name)s AS name,
+                   %(datetime)s AS datetime, %(currcpap)s AS currcpap,
+                   %(br)s AS br, %(apnea)s AS apnea, %(plot)s AS plot,
+                   %(room_number)s AS room_number) AS source
             ON (target.mrn = source.mrn OR
             target.room_number = source.room_number)
             WHEN MATCHED THEN
@@ -532,17 +885,20 @@ def upload_data(cursor, request):
                 source.currcpap, source.br, source.apnea,
                 source.plot);
         """
-        values = (
-            mrn,
-            name,
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            currcpap,
-            br,
-            apnea,
-            plot_base64,
-            room_number
-        )
+        values = {
+            "mrn": mrn,
+            # Whole seconds, as the datetimes are sent to the monitoring
+            # station and looked up again in that precision
+            "datetime": datetime.now().replace(microsecond=0),
+            "name": name,
+            "currcpap": currcpap,
+            "br": br,
+            "apnea": apnea,
+            "plot": plot_bytes,
+            "room_number": room_number
+        }
         cursor.execute(query, values)
+        read_cache.clear()
 
         return jsonify({"message": "Data uploaded successfully"})
     except pytds.tds_base.OperationalError as e:
@@ -563,7 +919,8 @@ def execute_update_patient_info():
     :return: the result of executing the update_patient_info
              function
     """
-    return execute_function(update_patient_info, cursor, request.files)
+    with get_cursor() as cursor:
+        return execute_function(update_patient_info, cursor, request.files)
 
 
 def update_patient_info(cursor, request):
@@ -597,55 +954,39 @@ def update_patient_info(cursor, request):
                                   "empty or contain invalid "
                                   "characters")}), 415
     if currcpap is None:
-        return jsonify({"error": ("Invalid CPAP pressure: "
-                                  "CPAP pressure out of range "
-                                  "(4-25 cmH\u2082O) and/or must "
-                                  "be a float")}), 416
+        return jsonify(invalid_cpap_error), 416
     if br is None:
         return jsonify({"error": "Invalid breathing rate"}), 417
     if apnea is None:
         return jsonify({"error": "Invalid apnea count"}), 418
 
     plot_bytes = plot_file.read() if plot_file else None
-    plot_base64 = (base64.b64encode(plot_bytes).decode('utf-8')
-                   if plot_bytes else None)
 
-    # Update the now table
+    # Update the now table and insert into the entries table in one
+    # batch, with a single timestamp and the plot sent once
     query = """
         UPDATE now
-        SET name = %s, currcpap = %s, br = %s,
-        apnea = %s, plot = %s, datetime = %s
-        WHERE mrn = %s
-    """
-    values = (
-        name,
-        currcpap,
-        br,
-        apnea,
-        plot_base64,
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        mrn
-    )
-    cursor.execute(query, values)
+        SET name = %(name)s, currcpap = %(currcpap)s, br = %(br)s,
+        apnea = %(apnea)s, plot = %(plot)s, datetime = %(datetime)s
+        WHERE mrn = %(mrn)s;
 
-    # Insert into entries table
-    query = """
         INSERT INTO entries (mrn, datetime, name,
         currcpap, br, apnea, plot, room_number)
-        VALUES (%s, %s, %s, %s, %s, %s, %s,
-        (SELECT TOP 1 room_number FROM now WHERE mrn = %s))
-    """
-    values = (
-        mrn,
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        name,
-        currcpap,
-        br,
-        apnea,
-        plot_base64,
-        mrn
-    )
+        VALUES (%(mrn)s, %(datetime)s, %(name)s, %(currcpap)s, %(br)s,
+        %(apnea)s, %(plot)s,
+        (SELECT TOP 1 room_number FROM now WHERE mrn = %(mrn)s))
+    """
+    values = {
+        "mrn": mrn,
+        "datetime": datetime.now().replace(microsecond=0),
+        "name": name,
+        "currcpap": currcpap,
+        "br": br,
+        "apnea": apnea,
+        "plot": plot_bytes or None
+    }
     cursor.execute(query, values)
+    read_cache.clear()
 
     return jsonify({"message": "Patient information updated successfully"})
 
@@ -665,7 +1006,8 @@ def fetch_mrn_from_room_number_handler():
     # in_json contains room_number
     in_json = request.get_json()
     room_number = in_json["room_number"]
-    return fetch_mrn_from_room_number(cursor, room_number)
+    with get_cursor() as cursor:
+        return fetch_mrn_from_room_number(cursor, room_number)
 
 
 def fetch_mrn_from_room_number(cursor, room_number):
@@ -682,10 +1024,29 @@ def fetch_mrn_from_room_number(cursor, room_number):
 
     :return: Flask response object containing the MRN as JSON
     """
-    query = f"SELECT mrn FROM now WHERE room_number = {room_number}"
-    cursor.execute(query)
+    return json_response(cached_query(("mrn", room_number),
+                                      query_mrn_from_room_number, cursor,
+                                      room_number))
+
+
+def query_mrn_from_room_number(cursor, room_number):
+    """Query the MRN for a given room number.
+
+    This function executes the SELECT query behind
+    fetch_mrn_from_room_number and returns the MRN itself, so that it
+    can be kept by cached_query.
+
+    :param cursor: pymssql.Cursor object representing the database
+                   cursor
+    :param room_number: int containing the room number to fetch
+                         the MRN for
+
+    :return: int containing the MRN of the patient in the room
+    """
+    query = "SELECT mrn FROM now WHERE room_number = %s"
+    cursor.execute(query, (room_number,))
     rn = cursor.fetchall()
-    return jsonify(rn[0][0])
+    return rn[0][0]
 
 
 @app.route('/fetch_datetimes_for_patient', methods=["POST"])
@@ -695,7 +1056,9 @@ def fetch_datetimes_for_patient_handler():
     This is a Flask route handler that handles a POST request
     to the '/fetch_datetimes_for_patient' endpoint. It extracts
     the MRN from the JSON payload and passes it to the
-    fetch_datetimes_for_patient function.
+    fetch_datetimes_for_patient function. Since the monitoring
+    station polls this endpoint, an unchanged list of datetimes is
+    answered with 304 Not Modified.
 
     :return: the result of executing the fetch_datetimes_for_patient
              function
@@ -703,7 +1066,9 @@ def fetch_datetimes_for_patient_handler():
     # in_json contains the relevant selected patient mrn
     in_json = request.get_json()
     mrn = in_json["mrn"]
-    return fetch_datetimes_for_patient(cursor, mrn)
+    with get_cursor() as cursor:
+        return conditional_response(fetch_datetimes_for_patient(cursor,
+                                                                mrn))
 
 
 def fetch_datetimes_for_patient(cursor, mrn):
@@ -721,10 +1086,28 @@ def fetch_datetimes_for_patient(cursor, mrn):
 
     :return: Flask response object containing the datetimes as JSON
     """
-    query = f"SELECT datetime FROM entries WHERE mrn = {mrn}"
-    cursor.execute(query)
+    return json_response(query_datetimes_for_patient(cursor, mrn))
+
+
+def query_datetimes_for_patient(cursor, mrn):
+    """Query the datetimes for a given patient MRN.
+
+    This function executes the SELECT query behind
+    fetch_datetimes_for_patient and returns the datetimes
+    themselves, so that they can also be combined with other
+    data in a single response.
+
+    :param cursor: pymssql.Cursor object representing the database
+                   cursor
+    :param mrn: int containing the patient MRN to fetch the datetimes
+                for
+
+    :return: list containing the datetimes of the patient's entries
+    """
+    query = "SELECT datetime FROM entries WHERE mrn = %s"
+    cursor.execute(query, (mrn,))
     datetimes = cursor.fetchall()
-    return jsonify([dt[0] for dt in datetimes])
+    return [dt[0] for dt in datetimes]
 
 
 @app.route('/fetch_plot_from_datetime_and_mrn', methods=["POST"])
@@ -743,7 +1126,8 @@ def fetch_plot_from_datetime_and_mrn_handler():
     # dt is string format
     dt = in_json["datetime"]
     mrn = in_json["mrn"]
-    return fetch_plot_from_datetime_and_mrn(cursor, dt, mrn)
+    with get_cursor() as cursor:
+        return fetch_plot_from_datetime_and_mrn(cursor, dt, mrn)
 
 
 def fetch_plot_from_datetime_and_mrn(cursor, dt, mrn):
@@ -761,11 +1145,44 @@ def fetch_plot_from_datetime_and_mrn(cursor, dt, mrn):
 
     :return: Flask response object containing the plot as JSON
     """
+    return json_response(query_plot_from_datetime_and_mrn(cursor, dt, mrn))
+
+
+def query_plot_from_datetime_and_mrn(cursor, dt, mrn):
+    """Query the plot for a given datetime and patient MRN.
+
+    This function executes the SELECT query behind
+    fetch_plot_from_datetime_and_mrn. Because an entry's plot never
+    changes, the base64-encoded plot is kept in plot_cache, and the
+    monitoring station's repeated requests for the same historic
+    plot are answered without querying the database. The least
+    recently used plots are dropped once the cache holds more than
+    plot_cache_bytes.
+
+    :param cursor: pymssql.Cursor object representing the database
+                   cursor
+    :param dt: str containing the datetime to fetch the plot for
+    :param mrn: int containing the patient MRN to fetch the plot for
+
+    :return: str containing the base64-encoded plot, or None if the
+             entry has no plot
+    """
+    key = (mrn, dt)
+    with plot_cache_lock:
+        if key in plot_cache:
+            plot_cache.move_to_end(key)
+            return plot_cache[key][1]
     # dt in form '2022-04-18 13:45:00'
-    query = f"SELECT plot FROM entries WHERE mrn = {mrn} AND datetime = '{dt}'"
-    cursor.execute(query)
+    query = "SELECT plot FROM entries WHERE mrn = %s AND datetime = %s"
+    cursor.execute(query, (mrn, dt))
     datetimes = cursor.fetchall()
-    return jsonify(datetimes[0][0])
+    plot = plot_to_base64_str(datetimes[0][0])
+    with plot_cache_lock:
+        plot_cache[key] = (len(plot or ""), plot)
+        total = sum(size for size, _ in plot_cache.values())
+        while total > plot_cache_bytes and len(plot_cache) > 1:
+            total -= plot_cache.popitem(last=False)[1][0]
+    return plot
 
 
 @app.route('/send_cpap', methods=["POST"])
@@ -785,9 +1202,10 @@ def send_cpap_handler():
     if validate_send_cpap(in_json):
         room_number = in_json["room_number"]
         cpap = in_json["cpap"]
-        return send_cpap(cursor, room_number, cpap)
+        with get_cursor() as cursor:
+            return send_cpap(cursor, room_number, cpap)
     else:
-        print("failed")
+        logger.debug("send_cpap: invalid input")
         return "invalid input", 400
 
 
@@ -796,24 +1214,20 @@ def validate_send_cpap(in_json):
 
     This function validates the input JSON payload for sending
     CPAP pressure. It checks if the JSON is a dictionary with
-    the required keys "room_number" and "cpap", and if the values
-    are of the correct types (integer for room number and float
-    for CPAP pressure).
+    exactly the required keys "room_number" and "cpap", in any
+    order, and if the values are of the correct types (integer for
+    room number and float for CPAP pressure).
 
     :param in_json: dict containing the input JSON payload
 
     :return: bool indicating whether the input is valid or not
     """
-    if ((type(in_json) is not dict) or
-            (list(in_json.keys()) != ["room_number", "cpap"])):
-        print("doesn't have required keys")
-        return False
-    if len(in_json) != 2:
-        print('number of keys wrong')
+    if type(in_json) is not dict or in_json.keys() != send_cpap_keys:
+        logger.debug("doesn't have required keys")
         return False
     if ((type(in_json["room_number"]) is not int or
          type(in_json["cpap"]) is not float)):
-        print("value types wrong")
+        logger.debug("value types wrong")
         return False
     return True
 
@@ -835,16 +1249,18 @@ def send_cpap(cursor, room_number, cpap):
     :return: tuple containing the update status message and HTTP
              status code
     """
-    query = (f"UPDATE now SET currcpap = {cpap} "
-             f"WHERE room_number = {room_number}")
-    cursor.execute(query)
+    query = "UPDATE now SET currcpap = %s WHERE room_number = %s"
+    cursor.execute(query, (cpap, room_number))
+    read_cache.clear()
     return "update successful", 200
 
 
 if __name__ == "__main__":
-    conn = connect_to_db()
-    cursor = conn.cursor()
+    logging.basicConfig(level=logging.WARNING)
+    prewarm_pool()
     app.run(port=5001)
-    cursor.close()
-    conn.close()
+    while not idle_connections.empty():
+        idle_connections.get_nowait()[0].close()
+    if connector is not None:
+        connector.close()
     print('server is off')
@@ -0,0 +1,89 @@
+import logging
+import numpy as np
+import pytest
+
+
+header = ("Time [s],Pressure V1-P2 [ADC],Pressure V1-P1-Ins [ADC],"
+          "Pressure V1-P1-Exp [ADC], Pressure V2-P2 [ADC],"
+          "Pressure V2-P1-Ins [ADC], Pressure V2-P1-Exp [ADC]\n")
+
+
+@pytest.mark.parametrize("lines, expected_rows, expected_errors", [
+    (["0.0,1,2,3,4,5,6\n", "0.01,1,2,3,4,5,6\n"], 2, 0),
+    (["0.0,1,2,3,4,5,abc\n"], 0, 1),
+    (["0.0,1,2,3,4,5,6\n", "bad data,1,2,3,4,5,6\n",
+      "0.02,,2,3,4,5,6\n", "0.03,NaN,2,3,4,5,6\n"], 1, 3),
+])
+def test_data_acquisition(lines, expected_rows, expected_errors,
+                          tmp_path, caplog):
+    from cpap_analysis import data_acquisition
+    filename = tmp_path / "patient.txt"
+    filename.write_text(header + "".join(lines))
+    logger = logging.getLogger("test_data_acquisition")
+
+    with caplog.at_level(logging.ERROR):
+        data = data_acquisition(str(filename), logger)
+
+    errors = [r for r in caplog.records if r.getMessage() == "Invalid Input"]
+    assert data.shape == (expected_rows, 7)
+    assert len(errors) == expected_errors
+
+
+def test_flow_vs_time_clamps_negative_pressure_difference():
+    from cpap_analysis import flow_vs_time, calculate_leakage
+    # p2 higher than both p1 channels would take the sqrt of a negative
+    data = np.array([[0.0, 5000, 4000, 1638, 0, 0, 0],
+                     [0.01, 5000, 1638, 4000, 0, 0, 0]])
+    logger = logging.getLogger("test_flow_vs_time")
+
+    flow_rate = flow_vs_time(data)
+
+    assert np.array_equal(flow_rate[:, 1], [0.0, 0.0])
+    assert np.isfinite(calculate_leakage(flow_rate, logger))
+
+
+def test_flow_vs_time_expiration_is_negative():
+    from cpap_analysis import flow_vs_time
+    data = np.array([[0.0, 1000, 4000, 1638, 0, 0, 0],
+                     [0.01, 1000, 1638, 4000, 0, 0, 0]])
+
+    flow_rate = flow_vs_time(data)
+
+    assert flow_rate[0, 1] > 0
+    assert flow_rate[1, 1] < 0
+    assert flow_rate[1, 1] == pytest.approx(-flow_rate[0, 1])
+
+
+def test_json_dump_same_output_with_and_without_orjson(
+        tmp_path, monkeypatch):
+    pytest.importorskip("orjson")
+    import cpap_analysis
+    metrics = {"duration": 56.51, "breaths": 2, "breath_rate_bpm": 2.124,
+               "breath_times": [1.25, 7.5], "apnea_count": 0,
+               "leakage": -0.5}
+
+    cpap_analysis.json_dump(str(tmp_path / "with_orjson"), metrics)
+    monkeypatch.setattr(cpap_analysis, "orjson", None)
+    cpap_analysis.json_dump(str(tmp_path / "without_orjson"), metrics)
+
+    assert ((tmp_path / "with_orjson.json").read_bytes() ==
+            (tmp_path / "without_orjson.json").read_bytes())
+    # The file keeps the json module's 4-space indentation
+    assert (tmp_path / "with_orjson.json").read_bytes().startswith(
+        b'{\n    "duration": 56.51,\n')
+
+
+def test_float32_data_stays_float32():
+    from cpap_analysis import flow_vs_time, detect_peak_times
+    time = np.arange(0, 30, 0.01)
+    data = np.zeros((time.size, 7), dtype=np.float32)
+    data[:, 0] = time
+    data[:, 1] = 1638
+    data[:, 2] = 1638 + 2000 * (np.sin(2 * np.pi * 0.25 * time) + 1)
+    data[:, 3] = 1638
+
+    flow_rate = flow_vs_time(data)
+    peak_times, filtered_flow_rate = detect_peak_times(flow_rate)
+
+    assert flow_rate.dtype == np.float32
+    assert filtered_flow_rate.dtype == np.float32
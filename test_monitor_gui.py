@@ -4,7 +4,9 @@ import pytest
 @pytest.mark.parametrize("input, expected", [
     ('Mon, 18 Apr 2024 12:00:35 GMT', '2024-04-18 12:00:35'),
     ('Tue, 31 Jan 2013 11:45:09 GMT', '2013-01-31 11:45:09'),
-    ('Sun, 21 Mar 1990 19:12:36 GMT', '1990-03-21 19:12:36')
+    ('Sun, 21 Mar 1990 19:12:36 GMT', '1990-03-21 19:12:36'),
+    ('2024-04-18 12:00:35', '2000-01-01 12:00:00'),
+    ('Mon, 18 Abc 2024 12:00:35 GMT', '2000-01-01 12:00:00')
 ])
 def test_convert_day_string(input, expected):
     from monitor_gui import convert_date_string
@@ -23,3 +25,30 @@ def test_b64_string_to_file():
                          "nis_output.png")
     os.remove("nis_output.png")
     assert answer
+
+
+def test_write_plot():
+    from monitor_gui import write_plot
+    import filecmp
+    import os
+    with open("nis.png", "rb") as in_file:
+        image_bytes = in_file.read()
+    write_plot(image_bytes, noname=True)
+    answer = filecmp.cmp("nis.png",
+                         "nis_output.png")
+    os.remove("nis_output.png")
+    assert answer
+
+
+def test_parse_json_same_output_with_and_without_orjson(monkeypatch):
+    pytest.importorskip("orjson")
+    import monitor_gui
+    import requests
+    response = requests.Response()
+    response._content = b'[123, "Ann", "Mon, 18 Apr 2024 12:00:35 GMT", 2.5]'
+
+    with_orjson = monitor_gui.parse_json(response)
+    monkeypatch.setattr(monitor_gui, "orjson", None)
+    without_orjson = monitor_gui.parse_json(response)
+
+    assert with_orjson == without_orjson
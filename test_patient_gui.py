@@ -7,6 +7,70 @@ from PIL import Image, ImageTk
 import tempfile
 
 
+def test_dump_json_same_data_with_and_without_orjson(monkeypatch):
+    import json
+    import patient_gui
+    data = {"mrn": "123", "name": "Ann", "currcpap": 12.5,
+            "room_number": "4", "force": False}
+
+    with_orjson = patient_gui.dump_json(data)
+    monkeypatch.setattr(patient_gui, "orjson", None)
+    without_orjson = patient_gui.dump_json(data)
+
+    assert json.loads(with_orjson) == json.loads(without_orjson) == data
+
+
+def test_parse_json_once_with_and_without_orjson(monkeypatch):
+    import requests
+    import patient_gui
+    response = requests.Response()
+    response._content = b'{"cpap_pressure": "12.5"}'
+    invalid = requests.Response()
+    invalid._content = b'<html>Internal Server Error</html>'
+
+    with_orjson = patient_gui.parse_json(response)
+    monkeypatch.setattr(patient_gui, "orjson", None)
+    without_orjson = patient_gui.parse_json(response)
+
+    assert with_orjson == without_orjson == {"cpap_pressure": "12.5"}
+    assert patient_gui.parse_json(invalid) is None
+
+
+def test_post_data(monkeypatch):
+    import json
+    import patient_gui
+    sent = {}
+
+    def mock_post(url, **kwargs):
+        sent[url] = kwargs
+
+    monkeypatch.setattr(patient_gui.session, "post", mock_post)
+    patient_gui.post_data("http://a/check", {"mrn": "1"})
+    patient_gui.post_data("http://a/upload", {"mrn": "1"}, b"png")
+
+    name, body, content_type = sent["http://a/check"]["files"]["data"]
+    assert json.loads(body) == {"mrn": "1"}
+    assert "plot" not in sent["http://a/check"]["files"]
+    plot = sent["http://a/upload"]["files"]["plot"]
+    assert plot == ("plot.png", b"png", "image/png")
+
+
+def test_decimate_flow_rate():
+    from patient_gui import decimate_flow_rate
+    t = np.linspace(0, 100, 10001)
+    flow_rate = np.column_stack((t, np.sin(t)))
+
+    envelope = decimate_flow_rate(flow_rate, 450)
+
+    assert len(envelope) <= 900
+    assert np.all(np.diff(envelope[:, 0]) >= 0)
+    assert envelope[:, 1].min() == flow_rate[:, 1].min()
+    assert envelope[:, 1].max() == flow_rate[:, 1].max()
+    # Short sessions are plotted as they are
+    np.testing.assert_array_equal(decimate_flow_rate(flow_rate[:900], 450),
+                                  flow_rate[:900])
+
+
 def test_select_cpap_file(monkeypatch):
     from patient_gui import select_cpap_file
     file_path = "path/to/file.txt"
@@ -73,7 +137,7 @@ def test_display_metrics(monkeypatch):
     mock_label_config_called = False
     mock_subplots_called = False
     mock_savefig_called = False
-    mock_open_called = False
+    mock_frombuffer_called = False
     mock_photoimage_called = False
     mock_showerror_called = False
 
@@ -97,9 +161,9 @@ def test_display_metrics(monkeypatch):
         nonlocal mock_savefig_called
         mock_savefig_called = True
 
-    def mock_open(*args, **kwargs):
-        nonlocal mock_open_called
-        mock_open_called = True
+    def mock_frombuffer(*args, **kwargs):
+        nonlocal mock_frombuffer_called
+        mock_frombuffer_called = True
         return Image.new('RGB', (100, 100))
 
     def mock_photoimage(*args, **kwargs):
@@ -113,7 +177,7 @@ def test_display_metrics(monkeypatch):
     monkeypatch.setattr(ttk, "Label", MockLabel)
     monkeypatch.setattr(plt, "subplots", mock_subplots)
     monkeypatch.setattr(plt, "savefig", mock_savefig)
-    monkeypatch.setattr(Image, "open", mock_open)
+    monkeypatch.setattr(Image, "frombuffer", mock_frombuffer)
     monkeypatch.setattr(ImageTk, "PhotoImage", mock_photoimage)
     monkeypatch.setattr(messagebox, "showerror", mock_showerror)
 
@@ -128,6 +192,6 @@ def test_display_metrics(monkeypatch):
     # Assert that the necessary functions were called
     assert mock_label_config_called
     assert mock_subplots_called
-    assert mock_open_called
+    assert mock_frombuffer_called
     assert mock_photoimage_called
     assert not mock_showerror_called
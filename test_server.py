@@ -1,19 +1,19 @@
 import pytest
 from google.cloud.sql.connector import Connector
 from flask import Flask, jsonify, request
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from functools import lru_cache
 import json
 import io
 from datetime import datetime
 from unittest.mock import Mock
 
 
-def connect_to_db():
+def connect_to_db(connector):
     project_id = 'the-dock-420320'
     region = 'us-east1'
     instance_name = 'cpap'
     INSTANCE_CONNECTION_NAME = f"{project_id}:{region}:{instance_name}"
-    connector = Connector()
     conn = connector.connect(
         INSTANCE_CONNECTION_NAME,
         "pytds",
@@ -28,28 +28,47 @@ def connect_to_db():
 app = Flask(__name__)
 
 
-def test_fetch_room_numbers():
-    from server import fetch_room_numbers
+@pytest.fixture(scope="session")
+def conn():
+    # One connector and connection to the test database shared by all
+    # tests, closed when they are done so its refresh thread stops
+    connector = Connector(refresh_strategy="lazy")
+    conn = connect_to_db(connector)
+    yield conn
+    conn.close()
+    connector.close()
+
 
-    conn = connect_to_db()
+@pytest.fixture
+def cursor(conn):
     cursor = conn.cursor()
+    yield cursor
+    cursor.close()
+
+
+@lru_cache(maxsize=None)
+def sample_plot_png():
+    # Rendered once, without pyplot, for the tests that upload a plot
+    fig = Figure()
+    fig.add_subplot().plot([1, 2, 3], [1, 2, 3])
+    plot_data = io.BytesIO()
+    fig.savefig(plot_data, format='png')
+    return plot_data.getvalue()
+
+
+def test_fetch_room_numbers(cursor):
+    from server import fetch_room_numbers
 
     with app.app_context():
         output = fetch_room_numbers(cursor).get_json()
     expected = [1, 2]
 
-    cursor.close()
-    conn.close()
-
     assert output == expected
 
 
-def test_fetch_cpap_calculated_data():
+def test_fetch_cpap_calculated_data(cursor):
     from server import fetch_cpap_calculated_data
 
-    conn = connect_to_db()
-    cursor = conn.cursor()
-
     with app.app_context():
         output = fetch_cpap_calculated_data(cursor, 2).get_json()
     expected_mrn = 9
@@ -58,10 +77,8 @@ def test_fetch_cpap_calculated_data():
     expected_currcpap = 16.5
     expected_br = 18.0
     expected_apnea = 1
-    expected_plot = 'plot_data'
-
-    cursor.close()
-    conn.close()
+    # The stored plot bytes b'plot_data' are sent base64-encoded
+    expected_plot = 'cGxvdF9kYXRh'
 
     assert output[0] == expected_mrn
     assert output[1] == expected_name
@@ -72,82 +89,57 @@ def test_fetch_cpap_calculated_data():
     assert output[6][:30] == expected_plot
 
 
-def test_fetch_mrn_from_room_number():
-    from server import fetch_mrn_from_room_number
-
-    conn = connect_to_db()
-    cursor = conn.cursor()
-
-    with app.app_context():
-        output = fetch_mrn_from_room_number(cursor, 1).get_json()
-
-    expected = 7
-
-    cursor.close()
-    conn.close()
-
-    assert output == expected
-
-
-def test_fetch_datetimes_for_patient():
-    from server import fetch_datetimes_for_patient
+def test_fetch_patient_snapshot(monkeypatch):
+    import server
+    from server import fetch_patient_snapshot
 
-    conn = connect_to_db()
-    cursor = conn.cursor()
+    monkeypatch.setattr(server, "read_cache", {})
+    mock_cursor = Mock()
+    calculated_data = (9, 'Melanie', 'Tue, 23 Apr 2024 05:30:35 GMT',
+                       '16.50', '18.00', 1, b'plot_data')
+    mock_cursor.fetchall.side_effect = [
+        [calculated_data],
+        [('Mon, 22 Apr 2024 04:10:00 GMT',),
+         ('Tue, 23 Apr 2024 05:30:35 GMT',)]]
 
     with app.app_context():
-        output = fetch_datetimes_for_patient(cursor, 1).get_json()
+        output = fetch_patient_snapshot(mock_cursor, 2).get_json()
 
-    expected = (['Fri, 18 Jun 2004 14:00:00 GMT',
-                 'Mon, 18 Apr 2022 13:45:00 GMT'])
+    # The stored plot bytes are sent base64-encoded
+    assert output["metrics"] == list(calculated_data[:6]) + ['cGxvdF9kYXRh']
+    assert output["datetimes"] == ['Mon, 22 Apr 2024 04:10:00 GMT',
+                                   'Tue, 23 Apr 2024 05:30:35 GMT']
+    # Both queries are sent in one batch
+    mock_cursor.execute.assert_called_once()
+    mock_cursor.nextset.assert_called_once()
 
-    cursor.close()
-    conn.close()
 
-    assert output == expected
-
-
-def test_fetch_mrn_from_room_number():
+@pytest.mark.parametrize("room_number, expected", [(1, 7)])
+def test_fetch_mrn_from_room_number(cursor, room_number, expected):
     from server import fetch_mrn_from_room_number
 
-    conn = connect_to_db()
-    cursor = conn.cursor()
-
     with app.app_context():
-        output = fetch_mrn_from_room_number(cursor, 1).get_json()
-
-    expected = 7
-
-    cursor.close()
-    conn.close()
+        output = fetch_mrn_from_room_number(cursor, room_number).get_json()
 
     assert output == expected
 
 
-def test_fetch_datetimes_for_patient():
+@pytest.mark.parametrize("mrn, expected", [
+                         (1, ['Fri, 18 Jun 2004 14:00:00 GMT',
+                              'Mon, 18 Apr 2022 13:45:00 GMT']),
+                         ])
+def test_fetch_datetimes_for_patient(cursor, mrn, expected):
     from server import fetch_datetimes_for_patient
 
-    conn = connect_to_db()
-    cursor = conn.cursor()
-
     with app.app_context():
-        output = fetch_datetimes_for_patient(cursor, 1).get_json()
-
-    expected = (['Fri, 18 Jun 2004 14:00:00 GMT',
-                 'Mon, 18 Apr 2022 13:45:00 GMT'])
-
-    cursor.close()
-    conn.close()
+        output = fetch_datetimes_for_patient(cursor, mrn).get_json()
 
     assert output == expected
 
 
-def test_fetch_plot_from_datetime_and_mrn():
+def test_fetch_plot_from_datetime_and_mrn(cursor):
     from server import fetch_plot_from_datetime_and_mrn
 
-    conn = connect_to_db()
-    cursor = conn.cursor()
-
     with app.app_context():
         output = fetch_plot_from_datetime_and_mrn(
             cursor,
@@ -157,14 +149,12 @@ def test_fetch_plot_from_datetime_and_mrn():
 
     expected = 'iVBORw0KGgoAAAANSUhEUgAAAoAAAA'
 
-    cursor.close()
-    conn.close()
-
     assert output[:30] == expected
 
 
 @pytest.mark.parametrize("input, expected", [
                          ({"room_number": 3, "cpap": 12.0}, True),
+                         ({"cpap": 12.0, "room_number": 3}, True),
                          ({"room_number": 3.2, "cpap": 12}, False),
                          ({"room_number": 3, "cpap": 12}, False),
                          ({"room_umber": 5, "cpap": 12}, False),
@@ -176,22 +166,15 @@ def test_validate_send_cpap(input, expected):
     assert output is expected
 
 
-def test_send_cpap():
+def test_send_cpap(cursor):
     from server import send_cpap
 
-    conn = connect_to_db()
-    cursor = conn.cursor()
-
     with app.app_context():
         send_cpap(cursor, 1, 10.00)
-        query = "SELECT COUNT(*) FROM now WHERE currcpap = 10.00"
-        cursor.execute(query)
-        assert cursor.fetchall()[0][0] == 1
-        query = f"UPDATE now SET currcpap = 15.50 WHERE room_number = 1"
-        cursor.execute(query)
-
-    cursor.close()
-    conn.close()
+        # The UPDATE reports the row of room 1 as changed
+        assert cursor.rowcount == 1
+        query = "UPDATE now SET currcpap = %s WHERE room_number = %s"
+        cursor.execute(query, (15.50, 1))
 
 
 @pytest.fixture
@@ -202,22 +185,18 @@ def client():
         yield client
 
 
-def test_check_exists(client):
+def test_check_exists(client, cursor):
     from server import check_exists
 
-    # Connect to the test database
-    conn = connect_to_db()
-    cursor = conn.cursor()
-
     try:
         # Set up test data
         test_data = [
             (754, 'John Doe',
              datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-             10.0, 15.0, 0, 'plot_data', '999'),
+             10.0, 15.0, 0, b'plot_data', '999'),
             (845, 'Jane Smith',
              datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-             12.0, 18.0, 1, 'plot_data', '234'),
+             12.0, 18.0, 1, b'plot_data', '234'),
         ]
 
         # Merge test data into the 'now' table
@@ -296,10 +275,8 @@ def test_check_exists(client):
         assert response.json == {}
     finally:
         # Clean up test data
-        delete_query = "DELETE FROM now WHERE mrn IN (754, 845)"
-        cursor.execute(delete_query)
-        cursor.close()
-        conn.close()
+        delete_query = "DELETE FROM now WHERE mrn IN (%s, %s)"
+        cursor.execute(delete_query, (754, 845))
 
 
 def test_fetch_cpap_pressure(client):
@@ -308,7 +285,7 @@ def test_fetch_cpap_pressure(client):
     mock_cursor = Mock()
 
     expected_query = ("SELECT currcpap FROM now WHERE "
-                      "mrn = 123 OR room_number = 456")
+                      "mrn = %s OR room_number = %s")
     expected_result = None  # No record found in the database
 
     mock_cursor.execute.return_value = None
@@ -326,24 +303,17 @@ def test_fetch_cpap_pressure(client):
     with app.app_context():
         response = fetch_cpap_pressure(mock_cursor, mock_request)
 
-    mock_cursor.execute.assert_called_once_with(expected_query)
+    mock_cursor.execute.assert_called_once_with(expected_query, (123, 456))
 
     assert response.status_code == 200
     assert response.get_json() == {'cpap_pressure': 10.5}
 
 
-def test_upload_data(client):
+def test_upload_data(client, cursor):
     from server import upload_data
 
-    conn = connect_to_db()
-    cursor = conn.cursor()
-
     # Create a sample plot image
-    fig, ax = plt.subplots()
-    ax.plot([1, 2, 3], [1, 2, 3])
-    plot_data = io.BytesIO()
-    fig.savefig(plot_data, format='png')
-    plot_data.seek(0)
+    plot_data = io.BytesIO(sample_plot_png())
 
     # Prepare the request data
     data = {
@@ -375,22 +345,62 @@ def test_upload_data(client):
     query = "DELETE FROM now WHERE room_number = 102"
     cursor.execute(query)
 
-    cursor.close()
-    conn.close()
 
+def test_upload_data_conflict():
+    from server import upload_data
 
-def test_update_patient_info(monkeypatch):
-    from server import update_patient_info
+    mock_cursor = Mock()
+    mock_cursor.fetchone.return_value = (1, 1)
 
-    conn = connect_to_db()
-    cursor = conn.cursor()
+    data = {
+        'mrn': '12345',
+        'name': 'John Doe',
+        'currcpap': '10',
+        'br': '20.5',
+        'apnea': '3',
+        'room_number': '102'
+    }
+    files = {
+        'data': (io.BytesIO(json.dumps(data).encode('utf-8')),
+                 'application/json'),
+        'plot': (io.BytesIO(b'plot'), 'image/jpeg')
+    }
+
+    with app.app_context():
+        with app.test_request_context(data=files,
+                                      content_type='multipart/form-data'):
+            response, status_code = upload_data(mock_cursor, request.files)
+
+    # Nothing is written until the client resends with force set
+    assert status_code == 409
+    assert response.json == {'conflict': 'room'}
+    mock_cursor.execute.assert_called_once()
+
+    data['force'] = True
+    files = {
+        'data': (io.BytesIO(json.dumps(data).encode('utf-8')),
+                 'application/json'),
+        'plot': (io.BytesIO(b'plot'), 'image/jpeg')
+    }
+    mock_cursor.reset_mock()
+    with app.app_context():
+        with app.test_request_context(data=files,
+                                      content_type='multipart/form-data'):
+            response = upload_data(mock_cursor, request.files)
+
+    # Both writes are sent in one batch
+    assert response.json == {'message': 'Data uploaded successfully'}
+    mock_cursor.execute.assert_called_once()
+    values = mock_cursor.execute.call_args[0][1]
+    assert values['mrn'] == 12345 and values['room_number'] == 102
+    assert values['plot'] == b'plot'
+
+
+def test_update_patient_info(monkeypatch, cursor):
+    from server import update_patient_info
 
     # Create a sample plot image
-    fig, ax = plt.subplots()
-    ax.plot([1, 2, 3], [1, 2, 3])
-    plot_data = io.BytesIO()
-    fig.savefig(plot_data, format='png')
-    plot_data.seek(0)
+    plot_data = io.BytesIO(sample_plot_png())
 
     # Prepare the request data
     data = {
@@ -420,9 +430,6 @@ def test_update_patient_info(monkeypatch):
     assert response.json == {'message': ('Patient information '
                                          'updated successfully')}
 
-    cursor.close()
-    conn.close()
-
 
 # Validation Tests:
 @pytest.mark.parametrize("name, expected", [
@@ -484,3 +491,121 @@ def test_validate_breath_rate(breath_rate, expected):
 def test_validate_apnea_count(apnea_count, expected):
     from server import validate_apnea_count
     assert validate_apnea_count(apnea_count) == expected
+
+
+def test_get_cursor_reuses_connections(monkeypatch):
+    import server
+    opened = []
+
+    def mock_connect_to_db():
+        opened.append(Mock())
+        return opened[-1]
+
+    monkeypatch.setattr(server, "connect_to_db", mock_connect_to_db)
+    monkeypatch.setattr(server, "idle_connections", server.queue.LifoQueue(
+        maxsize=server.pool_size))
+
+    with server.get_cursor():
+        with server.get_cursor():
+            pass  # a concurrent request gets another connection
+    with server.get_cursor() as cursor:
+        # the most recently used connection is taken first
+        assert cursor is opened[0].cursor.return_value
+    assert len(opened) == 2
+
+    # A connection that raised is closed instead of being reused
+    with pytest.raises(ValueError):
+        with server.get_cursor():
+            raise ValueError
+    opened[0].close.assert_called_once()
+    assert server.idle_connections.qsize() == 1
+
+    # A connection idle for too long is closed and replaced
+    monkeypatch.setattr(server, "connection_max_idle", -1)
+    with server.get_cursor() as cursor:
+        assert cursor is opened[2].cursor.return_value
+    opened[1].close.assert_called_once()
+
+    monkeypatch.setattr(server, "connection_max_idle", 60)
+    server.prewarm_pool(3)
+    assert len(opened) == 5
+    assert server.idle_connections.qsize() == 3
+
+
+def test_cached_query(monkeypatch):
+    import server
+    from server import cached_query, send_cpap
+
+    monkeypatch.setattr(server, "read_cache", {})
+    query = Mock(side_effect=[[1, 2], [1, 2, 3]])
+
+    assert cached_query(("rooms",), query, "cursor") == [1, 2]
+    assert cached_query(("rooms",), query, "cursor") == [1, 2]
+    query.assert_called_once_with("cursor")
+
+    # A write clears the cache, so the next read queries again
+    send_cpap(Mock(), 101, 12.0)
+    assert cached_query(("rooms",), query, "cursor") == [1, 2, 3]
+
+    # An expired result is queried again
+    server.read_cache[("rooms",)] = (
+        server.time.monotonic() - server.read_cache_ttl, [4])
+    query.side_effect = [[5]]
+    assert cached_query(("rooms",), query, "cursor") == [5]
+
+
+def test_json_response_same_with_and_without_orjson(monkeypatch):
+    import server
+    from decimal import Decimal
+    data = {"metrics": [9, 'Melanie', datetime(2024, 4, 23, 5, 30, 35),
+                        Decimal('16.50')],
+            "datetimes": [datetime(2024, 4, 22, 4, 10)]}
+
+    with app.app_context():
+        with_orjson = server.json_response(data).get_json()
+        monkeypatch.setattr(server, "orjson", None)
+        without_orjson = server.json_response(data).get_json()
+
+    assert with_orjson == without_orjson == {
+        "metrics": [9, 'Melanie', 'Tue, 23 Apr 2024 05:30:35 GMT', '16.50'],
+        "datetimes": ['Mon, 22 Apr 2024 04:10:00 GMT']}
+
+
+def test_query_plot_from_datetime_and_mrn_cached(monkeypatch):
+    import server
+    from server import query_plot_from_datetime_and_mrn
+
+    monkeypatch.setattr(server, "plot_cache", server.OrderedDict())
+    monkeypatch.setattr(server, "plot_cache_bytes", 20)
+    mock_cursor = Mock()
+    mock_cursor.fetchall.side_effect = [[(b'first plot',)],
+                                        [(b'second plot',)]]
+
+    dt = '2022-04-18 13:45:00'
+    assert query_plot_from_datetime_and_mrn(mock_cursor, dt, 1) == \
+        'Zmlyc3QgcGxvdA=='
+    assert query_plot_from_datetime_and_mrn(mock_cursor, dt, 1) == \
+        'Zmlyc3QgcGxvdA=='
+    assert mock_cursor.execute.call_count == 1
+
+    # Caching a second plot goes over the size limit and drops the first
+    query_plot_from_datetime_and_mrn(mock_cursor, dt, 2)
+    assert list(server.plot_cache) == [(2, dt)]
+
+
+def test_conditional_response():
+    from server import conditional_response
+    with app.test_request_context():
+        response = conditional_response(jsonify([1, 2]))
+        etag = response.headers["ETag"]
+    assert response.status_code == 200
+    with app.test_request_context(headers={"If-None-Match": etag}):
+        response = conditional_response(jsonify([1, 2]))
+    assert response.status_code == 304
+    assert response.get_data() == b""
+    with app.test_request_context(headers={"If-None-Match": etag}):
+        response = conditional_response(jsonify([1, 2, 3]))
+    assert response.status_code == 200
+    with app.test_request_context(headers={"If-None-Match": etag}):
+        error = (jsonify({"error": "Invalid CPAP pressure"}), 416)
+        assert conditional_response(error) is error